@@ -1,48 +1,199 @@
+import datetime
 import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, abort
 from flask_cors import CORS
-import dateutil.parser
-from models import setup_db, Movie, Actor
+from models import db, setup_db, Movie, Actor, Job
+import jobs
+import queries
+import tenants
 from auth import AuthError, requires_auth
+from routing import pinned_to_primary, read_only, read_engine, send_pin
+from coalesce import SingleFlight
+from health import DatabaseCheck, JwksCheck, readiness
+from formats import (MIMETYPES, request_body, respond, response_format,
+                     vary_on_accept)
+from instrumentation import install as install_instrumentation, query_budget
+from profiling import install as install_profiling
+from rowcache import list_body
+from writequeue import ValidationError, WriteUnavailable, writer_from_config
 
 
-def date_valid(date_str):
+PARSE_DEFAULTS = (datetime.datetime(2000, 1, 1),
+                  datetime.datetime(2001, 2, 2))
+
+
+def parse_date(date_str):
+    # Returns the date in date_str, or None when it holds no valid date.
+    if not isinstance(date_str, str):
+        return None
+    # ISO dates, the format the API itself returns, skip dateutil.
+    try:
+        return datetime.date.fromisoformat(date_str)
+    except ValueError:
+        pass
+    # dateutil is only needed for other formats, import it on first use.
+    import dateutil.parser
+    # dateutil takes the fields a string leaves out from a default date,
+    # so "room 12" would become the 12th of this month. Parsed against two
+    # defaults that differ in year, month and day, only a string that
+    # gives all three itself comes out the same.
+    try:
+        dates = {
+            dateutil.parser.parse(date_str, fuzzy=True, default=default)
+            for default in PARSE_DEFAULTS
+        }
+    except (ValueError, OverflowError, TypeError):
+        # dateutil raises OverflowError for huge numbers
+        return None
+    if len(dates) != 1:
+        return None
+    return dates.pop().date()
+
+
+def date_arg(name, default):
+    # Parse a date query argument, abort with 400 if it is not a date.
+    if name not in request.args:
+        return default
+    value = parse_date(request.args[name])
+    if value is None:
+        abort(400)
+    return value
+
+
+# The most ids a single batched GET may ask for.
+MAX_BATCH_IDS = 100
+
+
+def parse_ids(ids_arg):
+    # Parse "1,2,3" into a list of unique ids, keeping the request order.
     try:
-        validate_date_string = dateutil.parser.parse(date_str)
-        # if the dateutil.parser.parse can successfully parse the input date
-        # then the next line will run and return True
-        return True
+        ids = [int(part) for part in ids_arg.split(',')]
     except ValueError:
-        # if the dateutil.parser.parse can fails to parse the input date
-        return False
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) == 0 or len(ids) > MAX_BATCH_IDS:
+        abort(400)
+    return ids
+
+
+def in_request_order(ids, rows):
+    # Order rows as ids were requested and list the ids that had no row.
+    by_id = {row.id: row for row in rows}
+    found = [by_id[row_id] for row_id in ids if row_id in by_id]
+    missing = [row_id for row_id in ids if row_id not in by_id]
+    return found, missing
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.update(test_config)
+    setup_db(
+        app,
+        database_path=app.config.get('SQLALCHEMY_DATABASE_URI'),
+        create_schema=app.config.get('DB_CREATE_ALL')
+        )
     CORS(app)
+    # Pins clients that wrote to the primary, see routing.py.
+    app.after_request(send_pin)
+    # Bodies depend on the Accept header, see formats.py.
+    app.after_request(vary_on_accept)
+    # Opt-in request profiling, installed first so it sees the whole request.
+    install_profiling(app)
+    # Query counts, budgets and the slow query log, when enabled.
+    install_instrumentation(
+        app, [db.get_engine(app)] + app.extensions['replicas'].engines +
+        list(app.extensions['shards'].engines.values()))
+
+    # Concurrent identical list reads share one query and response body.
+    coalescer = SingleFlight()
+
+    def shared_body(key, build):
+        # A client pinned after its own write must not join a flight that
+        # started before its commit, it would miss its own rows.
+        if not app.config.get('COALESCE_READS', True) or \
+                pinned_to_primary():
+            return build()
+        # Replica and primary reads may differ, never mix the two, nor the
+        # reads of two tenant shards.
+        return coalescer.do(
+            key + (read_engine() is not None, tenants.current_shard()),
+            build)
+
+    # Optional group commit of POSTed rows, None unless GROUP_COMMIT is on.
+    writer = writer_from_config(app)
+
+    def list_response(build):
+        # build(fmt) returns the body in the format the client asked for.
+        fmt = response_format()
+        return app.response_class(
+            shared_body((request.full_path, fmt), lambda: build(fmt)),
+            mimetype=MIMETYPES[fmt])
+
+    # Load balancer probes, they need no token. The readiness check pings
+    # the primary database at most every READY_DB_CHECK_SECONDS.
+    db_check = DatabaseCheck(
+        db.get_engine(app),
+        interval=float(os.environ.get('READY_DB_CHECK_SECONDS', 5)))
+    # A missing JWKS is fetched from the probe, so a worker whose warm_up
+    # failed does not stay out of the load balancer for good.
+    jwks_check = JwksCheck(
+        interval=float(os.environ.get('READY_JWKS_RETRY_SECONDS', 5)))
+
+    @app.route('/healthz')
+    def healthz():
+        return respond({'success': True, 'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        ready, checks = readiness(db_check, jwks_check)
+        checks['success'] = ready
+        response = respond(checks)
+        response.status_code = 200 if ready else 503
+        return response
 
     @app.route('/actors')
+    @query_budget(1)
     @requires_auth('get:actors')
+    @read_only
     def get_all_actors(payload):
-        selection = Actor.query.all()
-        actors = [actor.format() for actor in selection]
-        # Abort if there are no actors in the database.
-        if len(actors) == 0:
+        # Batched lookup, GET /actors?ids=1,2,3, in a single query.
+        if 'ids' in request.args:
+            ids = parse_ids(request.args['ids'])
+            found, missing = in_request_order(
+                ids, queries.actors_by_ids(ids))
+            return respond({
+                'success': True,
+                'actors': [actor.format() for actor in found],
+                'missing': missing
+            })
+
+        def list_actors(fmt):
+            selection = queries.actor_rows()
+            # Abort if there are no actors in the database.
+            if len(selection) == 0:
+                abort(404)
+            return list_body('actors', 'Actor', selection, fmt)
+        return list_response(list_actors)
+
+    @app.route('/actors/<int:actor_id>')
+    @query_budget(1)
+    @requires_auth('get:actors')
+    @read_only
+    def get_actor(payload, actor_id):
+        actor = queries.actor_by_id(actor_id)
+        if actor is None:
             abort(404)
-        return jsonify({
-            'success': True,
-            'actors': actors
-        })
+        return respond({"success": True, "actor": actor.format()})
 
     @app.route('/actors', methods=['POST'])
+    @query_budget(3)
     @requires_auth('post:actors')
     def create_actor(payload):
         try:
             # Get new actor data from request.
-            body = request.get_json()
+            body = request_body()
             new_name = body.get('name', None)
             new_age = body.get('age', None)
             new_gender = body.get('gender', None)
@@ -52,16 +203,35 @@ def create_app(test_config=None):
             # Validate that the gender is the proper format, if not, abort.
             if (new_gender.upper() != 'M') and (new_gender.upper() != 'F'):
                 return abort(422)
-            # Format and create the actor object.
-            actors_selection = Actor.query.all()
-            for actor in actors_selection:
-                if (actor.name.upper() == new_name.upper()):
+            # With group commit the writer checks the name and commits the
+            # actor together with other requests' inserts.
+            if writer is not None:
+                try:
+                    actor = writer.submit(
+                        lambda: Actor(
+                            name=new_name, age=new_age,
+                            gender=new_gender.upper()
+                            ),
+                        unique=('Actor', new_name.upper()),
+                        taken=lambda: queries.actor_name_taken(new_name)
+                        )
+                except ValidationError:
                     abort(422)
+                except WriteUnavailable:
+                    abort(503)
+                return respond({
+                    'success': True,
+                    "actor": actor
+                    })
+            # Reject a name that is already taken, ignoring case.
+            if queries.actor_name_taken(new_name):
+                abort(422)
+            # Format and create the actor object.
             actor = Actor(
                 name=new_name, age=new_age, gender=new_gender.upper()
                 )
             actor.insert()
-            return jsonify({
+            return respond({
                 'success': True,
                 "actor": actor.format()
                 })
@@ -69,15 +239,16 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('patch:actors')
     def modify_actor(payload, actor_id):
         try:
             # Find the actor with the given id, if they don't exist abort.
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+            actor = queries.actor_by_id(actor_id)
             if actor is None:
                 abort(404)
             # Retrieve the updated actor data.
-            body = request.get_json()
+            body = request_body()
             new_name = body.get('name', None)
             new_age = body.get('age', None)
             new_gender = body.get('gender', None)
@@ -92,59 +263,112 @@ def create_app(test_config=None):
                     return abort(422)
                 actor.gender = new_gender.upper()
             actor.update()
-            return jsonify({"success": True, "actor": actor.format()})
+            return respond({"success": True, "actor": actor.format()})
         except AuthError:
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
         try:
             # Find the actor with the given id, if they don't exist abort.
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+            actor = queries.actor_by_id(actor_id)
             if actor is None:
                 abort(404)
             actor.delete()
-            return jsonify({"success": True, "delete": actor_id})
+            return respond({"success": True, "delete": actor_id})
         except AuthError:
             abort(422)
 
     @app.route('/movies')
+    @query_budget(1)
     @requires_auth('get:movies')
+    @read_only
     def get_all_movies(payload):
-        selection = Movie.query.all()
-        movies = [movie.format() for movie in selection]
-        # Abort if there are no movies in the database.
-        if len(movies) == 0:
+        # Batched lookup, GET /movies?ids=1,2,3, in a single query.
+        if 'ids' in request.args:
+            ids = parse_ids(request.args['ids'])
+            found, missing = in_request_order(
+                ids, queries.movies_by_ids(ids))
+            return respond({
+                'success': True,
+                'movies': [movie.format() for movie in found],
+                'missing': missing
+            })
+
+        # Releases between two dates, GET /movies?released_from=...&
+        # released_to=..., either bound may be left out.
+        released = 'released_from' in request.args or \
+            'released_to' in request.args
+        released_from = date_arg('released_from', datetime.date.min)
+        released_to = date_arg('released_to', datetime.date.max)
+
+        def list_movies(fmt):
+            if released:
+                selection = queries.movie_rows_released(
+                    released_from, released_to)
+            else:
+                selection = queries.movie_rows()
+            # Abort if there are no movies in the database.
+            if len(selection) == 0:
+                abort(404)
+            return list_body('movies', 'Movie', selection, fmt)
+        return list_response(list_movies)
+
+    @app.route('/movies/<int:movie_id>')
+    @query_budget(1)
+    @requires_auth('get:movies')
+    @read_only
+    def get_movie(payload, movie_id):
+        movie = queries.movie_by_id(movie_id)
+        if movie is None:
             abort(404)
-        return jsonify({
-            'success': True,
-            'movies': movies
-        })
+        return respond({"success": True, "movie": movie.format()})
 
     @app.route('/movies', methods=['POST'])
+    @query_budget(3)
     @requires_auth('post:movies')
     def create_movie(payload):
         try:
             # Get new movie data from request.
-            body = request.get_json()
+            body = request_body()
             new_title = body.get('title', None)
             new_release_date = body.get('release_date', None)
             # Validate that all fields are present, if not, abort.
             if (new_title is None) or (new_release_date is None):
                 return abort(422)
             # Validate that the inputed date is properly format, if not, abort.
-            if not date_valid(new_release_date):
+            new_release_date = parse_date(new_release_date)
+            if new_release_date is None:
                 return abort(422)
-            # Format and create the movie object.
-            movies_selection = Movie.query.all()
-            for movie in movies_selection:
-                if (movie.title.upper() == new_title.upper()):
+            # With group commit the writer checks the title and commits the
+            # movie together with other requests' inserts.
+            if writer is not None:
+                try:
+                    movie = writer.submit(
+                        lambda: Movie(
+                            title=new_title, release_date=new_release_date
+                            ),
+                        unique=('Movie', new_title.upper()),
+                        taken=lambda: queries.movie_title_taken(new_title)
+                        )
+                except ValidationError:
                     abort(422)
+                except WriteUnavailable:
+                    abort(503)
+                return respond({
+                    'success': True,
+                    "movie": movie
+                    })
+            # Reject a title that is already taken, ignoring case.
+            if queries.movie_title_taken(new_title):
+                abort(422)
+            # Format and create the movie object.
             movie = Movie(title=new_title, release_date=new_release_date)
             # Otherwise, create a row in the database for the movie.
             movie.insert()
-            return jsonify({
+            return respond({
                 'success': True,
                 "movie": movie.format()
                 })
@@ -152,16 +376,17 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @query_budget(3)
     @requires_auth('patch:movies')
     def modify_movie(payload, movie_id):
         try:
             # Find the movie with the given id, if it doesn't exist abort.
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+            movie = queries.movie_by_id(movie_id)
             if movie is None:
                 abort(404)
 
             # Retrieve the updated movie data.
-            body = request.get_json()
+            body = request_body()
             new_title = body.get('title', None)
             new_release_date = body.get('release_date', None)
 
@@ -169,33 +394,87 @@ def create_app(test_config=None):
             if new_title is not None:
                 movie.title = new_title
             if new_release_date is not None:
-                if not date_valid(new_release_date):
+                new_release_date = parse_date(new_release_date)
+                if new_release_date is None:
                     abort(422)
                 movie.release_date = new_release_date
             movie.update()
-            return jsonify({"success": True, "movie": movie.format()})
+            return respond({"success": True, "movie": movie.format()})
         except AuthError:
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
         try:
             # Find the movie with the given id, if it doesn't exist abort.
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+            movie = queries.movie_by_id(movie_id)
             if movie is None:
                 abort(404)
 
             movie.delete()
-            return jsonify({"success": True, "delete": movie_id})
+            return respond({"success": True, "delete": movie_id})
         except AuthError:
             abort(422)
 
+    @app.route('/jobs', methods=['POST'])
+    @query_budget(2)
+    @requires_auth(None)
+    def create_job(payload):
+        # Queue a background job, the permissions it needs depend on its kind.
+        body = request_body()
+        if not isinstance(body, dict) or \
+                body.get('kind') not in jobs.JOB_KINDS:
+            abort(422)
+        params = body.get('params', {})
+        if not isinstance(params, dict):
+            abort(422)
+        # Jobs belong to the token's subject, a token without one can not
+        # submit any.
+        submitted_by = payload.get('sub')
+        if not isinstance(submitted_by, str):
+            abort(401)
+        permissions = jobs.JOB_KINDS[body['kind']][1]
+        if not set(permissions) <= set(payload.get('permissions', [])):
+            abort(401)
+        job = jobs.submit(body['kind'], params, submitted_by,
+                          tenants.current_tenant())
+        response = respond({"success": True, "job": job.format()})
+        response.status_code = 202
+        response.headers['Location'] = '/jobs/{}'.format(job.id)
+        return response
+
+    def own_job(payload, job_id):
+        # Clients only see the jobs they submitted for their tenant.
+        job = Job.query.get(job_id)
+        if job is None or job.submitted_by != payload.get('sub') or \
+                job.tenant != tenants.current_tenant():
+            abort(404)
+        return job
+
+    @app.route('/jobs/<int:job_id>')
+    @query_budget(1)
+    @requires_auth(None)
+    def get_job(payload, job_id):
+        job = own_job(payload, job_id)
+        return respond({"success": True, "job": job.format()})
+
+    @app.route('/jobs/<int:job_id>', methods=['DELETE'])
+    @query_budget(4)
+    @requires_auth(None)
+    def cancel_job(payload, job_id):
+        job = own_job(payload, job_id)
+        # A job that has already finished can not be cancelled.
+        if not jobs.cancel(job):
+            abort(422)
+        return respond({"success": True, "job": job.format()})
+
     # Error handling
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return respond({
             "success": False,
             "error": 400,
             "message": "bad request"
@@ -203,15 +482,23 @@ def create_app(test_config=None):
 
     @app.errorhandler(401)
     def unauthorized(error):
-        return jsonify({
+        return respond({
             "success": False,
             "error": 401,
             "message": "unauthorized"
         }), 401
 
+    @app.errorhandler(403)
+    def forbidden(error):
+        return respond({
+            "success": False,
+            "error": 403,
+            "message": "forbidden"
+        }), 403
+
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return respond({
             "success": False,
             "error": 404,
             "message": "resource not found"
@@ -219,15 +506,23 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return respond({
             "success": False,
             "error": 422,
             "message": "unprocessable"
         }), 422
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return respond({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503
+
     @app.errorhandler(AuthError)
     def handle_invalid_usage(error):
-        return jsonify({
+        return respond({
             "success": False,
             "error": error.error,
             "message": error.status_code
@@ -1,14 +1,37 @@
 import json
-from flask import request, _request_ctx_stack, abort
-from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from flask import request, _request_ctx_stack, abort, g
+from functools import wraps, lru_cache
+from health import RollingLatency
+import tenants
+import logging
 import os
+import threading
+import time
 
+logger = logging.getLogger(__name__)
+
+'''
+auth_config()
+    reads the Auth0 settings from the environment the first time they are
+    needed rather than at import, so importing this module never fails or
+    blocks on configuration
+'''
+
+
+@lru_cache(maxsize=None)
+def auth_config():
+    # ALGORITHMS may be a plain list ("RS256,RS384") or written the way
+    # setup.sh does it, "['RS256']".
+    algorithms = [
+        algorithm.strip(' \'"')
+        for algorithm in os.environ['ALGORITHMS'].strip('[]').split(',')
+    ]
+    return {
+        'AUTH0_DOMAIN': os.environ['AUTH0_DOMAIN'],
+        'ALGORITHMS': [algorithm for algorithm in algorithms if algorithm],
+        'API_AUDIENCE': os.environ['API_AUDIENCE']
+    }
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
 
 # AuthError Exception
 '''
@@ -90,6 +113,236 @@ def check_permissions(permission, payload):
         }, abort(401))
     return True
 
+'''
+JWKS cache
+
+    The Auth0 signing keys change rarely, so they are fetched once and kept
+    for JWKS_CACHE_SECONDS (default 600) instead of being downloaded on
+    every request. An unknown kid forces a refresh, at most once every
+    JWKS_MIN_REFRESH_SECONDS (default 30), so key rotation is picked up.
+'''
+
+_jwks_lock = threading.Lock()
+_jwks_cache = {'jwks': None, 'fetched_at': 0.0}
+# How long JWKS downloads take, reported by GET /readyz.
+jwks_latency = RollingLatency()
+
+
+def fetch_jwks():
+    from urllib.request import urlopen
+    domain = auth_config()['AUTH0_DOMAIN']
+    jsonurl = urlopen(f'https://{domain}/.well-known/jwks.json')
+    return json.loads(jsonurl.read())
+
+
+def get_jwks(refresh=False):
+    max_age = float(os.environ.get('JWKS_CACHE_SECONDS', 600))
+    min_refresh = float(os.environ.get('JWKS_MIN_REFRESH_SECONDS', 30))
+    age = time.time() - _jwks_cache['fetched_at']
+    jwks = _jwks_cache['jwks']
+    if jwks is not None and age < max_age and \
+            not (refresh and age >= min_refresh):
+        return jwks
+    with _jwks_lock:
+        # Another thread may have refreshed the keys while we waited.
+        if _jwks_cache['jwks'] is not jwks:
+            return _jwks_cache['jwks']
+        started = time.perf_counter()
+        try:
+            _jwks_cache['jwks'] = fetch_jwks()
+        finally:
+            jwks_latency.record(time.perf_counter() - started)
+        _jwks_cache['fetched_at'] = time.time()
+        return _jwks_cache['jwks']
+
+
+def jwks_status():
+    # Describes the cached JWKS. age_seconds is None for a JWKS installed
+    # with load_jwks, which never expires.
+    jwks = _jwks_cache['jwks']
+    if jwks is None:
+        return {'loaded': False, 'keys': 0, 'age_seconds': None,
+                'fresh': False}
+    fetched_at = _jwks_cache['fetched_at']
+    age = None if fetched_at == float('inf') else \
+        round(time.time() - fetched_at, 1)
+    max_age = float(os.environ.get('JWKS_CACHE_SECONDS', 600))
+    return {
+        'loaded': True,
+        'keys': len(jwks.get('keys', [])),
+        'age_seconds': age,
+        'fresh': age is None or age < max_age
+    }
+
+
+def load_jwks(jwks):
+    # Installs a JWKS without fetching it, e.g. a locally generated one for
+    # tests and benchmarks. It is kept until load_jwks is called again.
+    with _jwks_lock:
+        _jwks_cache['jwks'] = jwks
+        _jwks_cache['fetched_at'] = float('inf')
+
+
+'''
+warm_up()
+    loads the JWKS and builds the key registry ahead of the first request.
+    Under gunicorn's preload_app this runs in the master process, so every
+    worker forked afterwards shares the warm state copy-on-write.
+    Failures are logged, the keys are then fetched on the first request.
+'''
+
+
+def warm_up():
+    try:
+        key_registry()
+    except Exception:
+        logger.warning('Unable to preload the JWKS.', exc_info=True)
+
+
+'''
+Key registry
+
+    Maps each kid in the JWKS to a public key that is constructed once, when
+    the JWKS is loaded, instead of on every request. Keys are backed by the
+    cryptography package (OpenSSL) when it is installed and by jose's own
+    RSA implementation otherwise.
+'''
+
+
+def b64url_decode(value):
+    import base64
+    if isinstance(value, str):
+        value = value.encode('ascii')
+    return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+
+
+class CryptographyRSAKey:
+    def __init__(self, jwk):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding, rsa
+        from cryptography.exceptions import InvalidSignature
+        numbers = rsa.RSAPublicNumbers(
+            int.from_bytes(b64url_decode(jwk['e']), 'big'),
+            int.from_bytes(b64url_decode(jwk['n']), 'big'))
+        self.key = numbers.public_key(default_backend())
+        self.padding = padding.PKCS1v15()
+        self.hashes = {
+            'RS256': hashes.SHA256,
+            'RS384': hashes.SHA384,
+            'RS512': hashes.SHA512
+        }
+        self.invalid_signature = InvalidSignature
+
+    def verify(self, signing_input, signature, algorithm):
+        if algorithm not in self.hashes:
+            return False
+        try:
+            self.key.verify(signature, signing_input, self.padding,
+                            self.hashes[algorithm]())
+        except self.invalid_signature:
+            return False
+        return True
+
+
+class JoseRSAKey:
+    def __init__(self, jwk):
+        self.jwk = {
+            'kty': jwk['kty'],
+            'kid': jwk['kid'],
+            'n': jwk['n'],
+            'e': jwk['e']
+        }
+        self.keys = {}
+
+    def verify(self, signing_input, signature, algorithm):
+        from jose import jwk
+        if algorithm not in ('RS256', 'RS384', 'RS512'):
+            return False
+        if algorithm not in self.keys:
+            self.keys[algorithm] = jwk.construct(self.jwk, algorithm)
+        return self.keys[algorithm].verify(signing_input, signature)
+
+
+def public_key_class():
+    try:
+        import cryptography.hazmat.primitives.asymmetric.rsa  # noqa: F401
+    except ImportError:
+        return JoseRSAKey
+    return CryptographyRSAKey
+
+
+def build_key_registry(jwks):
+    key_class = public_key_class()
+    return {
+        key['kid']: key_class(key)
+        for key in jwks['keys']
+        if key.get('kty') == 'RSA' and key.get('use', 'sig') == 'sig'
+    }
+
+
+def key_registry(refresh=False):
+    jwks = get_jwks(refresh)
+    if _jwks_cache.get('registry_for') is not jwks:
+        _jwks_cache['registry'] = build_key_registry(jwks)
+        _jwks_cache['registry_for'] = jwks
+    return _jwks_cache['registry']
+
+
+'''
+    @INPUTS
+        payload: the decoded, not yet verified, jwt payload
+
+    Check the cheap registered claims (exp, nbf, aud, iss) so expired or
+    misdirected tokens are rejected before the RSA signature check. The
+    payload is not verified yet, so the claims' types are checked before
+    they are compared.
+    Raise an AuthError if a claim does not hold.
+'''
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def claims_well_formed(payload):
+    for claim in ('exp', 'nbf'):
+        if claim in payload and not is_number(payload[claim]):
+            return False
+    audience = payload.get('aud')
+    if isinstance(audience, list):
+        return all(isinstance(item, str) for item in audience)
+    return isinstance(audience, str)
+
+
+def check_claims(payload, config):
+    if not claims_well_formed(payload):
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Malformed claims.'
+        }, abort(401))
+
+    now = time.time()
+    if 'exp' in payload and not payload['exp'] > now:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, abort(401))
+
+    audience = payload.get('aud')
+    if isinstance(audience, str):
+        audience = [audience]
+    issuer = 'https://' + config['AUTH0_DOMAIN'] + '/'
+    if ('nbf' in payload and payload['nbf'] > now) or \
+            not audience or config['API_AUDIENCE'] not in audience or \
+            payload.get('iss') != issuer:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims.' +
+            ' Please, check the audience and issuer.'
+        }, abort(401))
+
+
 '''
     @INPUTS
         token: a json web token (string)
@@ -103,62 +356,54 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
+    config = auth_config()
+    try:
+        encoded_header, encoded_payload, encoded_signature = \
+            token.split('.')
+        unverified_header = json.loads(b64url_decode(encoded_header))
+        unverified_payload = json.loads(b64url_decode(encoded_payload))
+        signature = b64url_decode(encoded_signature)
+        if not isinstance(unverified_header, dict) or \
+                not isinstance(unverified_payload, dict):
+            raise ValueError('JWT segments must be JSON objects.')
+    except (ValueError, TypeError):
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, abort(401))
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-
-            return payload
-
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, abort(401))
-
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims.' +
-                ' Please, check the audience and issuer.'
-            }, abort(401))
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, abort(400))
-    raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-            }, abort(400))
+    if not isinstance(unverified_header.get('kid'), str):
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, abort(401))
+
+    public_key = key_registry().get(unverified_header['kid'])
+    if public_key is None:
+        public_key = key_registry(refresh=True).get(unverified_header['kid'])
+    if public_key is None:
+        raise AuthError({
+                    'code': 'invalid_header',
+                    'description': 'Unable to find the appropriate key.'
+                }, abort(400))
+
+    check_claims(unverified_payload, config)
+
+    algorithm = unverified_header.get('alg')
+    signing_input = (encoded_header + '.' + encoded_payload).encode('ascii')
+    if algorithm not in config['ALGORITHMS'] or \
+            not public_key.verify(signing_input, signature, algorithm):
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, abort(400))
+    return unverified_payload
+
 
 '''
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), or None to
+            accept any valid token and leave the checks to the view
 
     Use the get_token_auth_header method to get the token
     Use the verify_decode_jwt method to decode the jwt
@@ -181,10 +426,18 @@ def requires_auth(permission=''):
                 payload = verify_decode_jwt(token)
             except AuthError:
                 abort(401)
-            try:
-                check_permissions(permission, payload)
-            except AuthError:
-                abort(401)
+            if permission is not None:
+                try:
+                    check_permissions(permission, payload)
+                except AuthError:
+                    abort(401)
+            # A tenant without a shard must not share DATABASE_URL.
+            if tenants.token_refused(payload):
+                raise AuthError({
+                    'code': 'unknown_tenant',
+                    'description': 'No database for this tenant.'
+                }, abort(403))
+            g.current_user = payload
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
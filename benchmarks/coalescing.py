@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import event
+from benchmarks.common import bench_app, bench_headers
+
+'''
+Thundering herd benchmark
+
+    Fires a burst of simultaneous GET /actors requests at one app, as after
+    a cache expiry or a deploy, and counts the SELECTs that reach the
+    database with and without request coalescing.
+
+        python -m benchmarks.coalescing [concurrent requests] [rows]
+'''
+
+
+def herd(app, headers, clients):
+    from models import db
+    counts = {'queries': 0}
+
+    def count(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            counts['queries'] += 1
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', count)
+    barrier = threading.Barrier(clients)
+    statuses = []
+
+    def request():
+        client = app.test_client()
+        barrier.wait()
+        statuses.append(client.get('/actors', headers=headers).status_code)
+
+    threads = [threading.Thread(target=request) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    event.remove(engine, 'before_cursor_execute', count)
+    assert statuses == [200] * clients, statuses
+    return counts['queries'], elapsed
+
+
+def main(clients=200, rows=20000):
+    headers = bench_headers(['get:actors'])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = 'sqlite:///' + os.path.join(tmp, 'herd.db')
+        bench_app(path, actors=rows)
+        for coalesce in (False, True):
+            app = bench_app(path, config={
+                'COALESCE_READS': coalesce, 'DB_CREATE_ALL': False})
+            queries, elapsed = herd(app, headers, clients)
+            print('{:<16} {} requests: {:4d} list queries, {:6.2f} s'.format(
+                'coalesced' if coalesce else 'not coalesced', clients,
+                queries, elapsed))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
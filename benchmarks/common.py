@@ -0,0 +1,61 @@
+import datetime
+import os
+import time
+
+'''
+Shared benchmark helpers
+
+    bench_app() builds an application on a SQLite database (in memory by
+    default) seeded with the requested number of actors and movies, and
+    bench_headers() signs a token with a local key, so benchmarks run
+    without Postgres or Auth0.
+'''
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('AUTH0_DOMAIN', 'example.auth0.com')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'capstoneCastingAPI')
+os.environ.setdefault('DB_CREATE_ALL', 'false')
+
+
+def bench_app(database_url='sqlite://', actors=0, movies=0, config=None):
+    from app import create_app
+    from models import db, Actor, Movie
+
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'DB_CREATE_ALL': True
+    }
+    if database_url == 'sqlite://':
+        # Share the single in-memory database between threads.
+        from sqlalchemy.pool import StaticPool
+        settings['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': StaticPool,
+            'connect_args': {'check_same_thread': False}
+        }
+    settings.update(config or {})
+    app = create_app(settings)
+    with app.app_context():
+        first_release = datetime.date(1950, 1, 1)
+        db.session.add_all(
+            Actor(name='Actor {}'.format(i), age=20 + i % 60,
+                  gender='MF'[i % 2])
+            for i in range(actors))
+        db.session.add_all(
+            Movie(title='Movie {}'.format(i),
+                  release_date=first_release + datetime.timedelta(days=i))
+            for i in range(movies))
+        db.session.commit()
+    return app
+
+
+def per_call(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_headers(permissions):
+    from testing import LocalSigner
+    return LocalSigner(kid='bench').headers(permissions, sub='bench')
@@ -0,0 +1,54 @@
+import sys
+import time
+from benchmarks import common  # noqa: F401 (sets the benchmark environment)
+
+'''
+Date parsing benchmark
+
+    Parses a mix of release date formats, as POST and PATCH /movies
+    receive them, with the old path (date_valid() parsing with dateutil,
+    then the string parsed again) and with app.parse_date(), and reports
+    dates/sec.
+
+        python -m benchmarks.date_parsing [iterations]
+'''
+
+DATES = [
+    '2019-08-31', '2020-01-08', '1999-12-31', '2015-09-20',
+    'September 20, 2015', '20 Sep 2015', '09/20/2015', 'not a date'
+]
+
+
+def legacy_parse(date_str):
+    # The old create_movie: validate with dateutil, keep the string, and
+    # parse it again to store it.
+    import dateutil.parser
+    try:
+        dateutil.parser.parse(date_str)
+    except ValueError:
+        return None
+    return dateutil.parser.parse(date_str).date()
+
+
+def rate(parse, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for date_str in DATES:
+            parse(date_str)
+    return iterations * len(DATES) / (time.perf_counter() - start)
+
+
+def main(iterations=5000):
+    from app import parse_date
+    for date_str in DATES:
+        assert legacy_parse(date_str) == parse_date(date_str), date_str
+    iso = sum(1 for date_str in DATES if date_str[:4].isdigit())
+    print('{} formats, {} of them ISO'.format(len(DATES), iso))
+    print('old:        {:10.0f} dates/sec'.format(
+        rate(legacy_parse, iterations)))
+    print('parse_date: {:10.0f} dates/sec'.format(
+        rate(parse_date, iterations)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
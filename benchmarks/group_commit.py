@@ -0,0 +1,69 @@
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.common import bench_app
+
+'''
+Group commit benchmark
+
+    Runs CLIENTS threads that each insert actors as fast as they can, as
+    concurrent POST /actors requests would, first with a commit per insert
+    and then through a GroupCommitWriter at a few batching delays, and
+    prints inserts/sec on a file-backed SQLite database.
+
+        python -m benchmarks.group_commit [clients] [inserts per client]
+'''
+
+
+def run_clients(clients, per_client, insert):
+    barrier = threading.Barrier(clients)
+
+    def client(number):
+        barrier.wait()
+        for i in range(per_client):
+            insert('Actor {}-{}'.format(number, i))
+
+    threads = [threading.Thread(target=client, args=(number,))
+               for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * per_client / (time.perf_counter() - start)
+
+
+def main(clients=32, per_client=50):
+    from models import db, Actor
+    from writequeue import GroupCommitWriter
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app('sqlite:///' + os.path.join(tmp, 'inserts.db'))
+        runs = itertools.count()
+
+        def direct(name):
+            with app.app_context():
+                Actor(name=name, age=30, gender='F').insert()
+                db.session.remove()
+
+        print('{:<28} {:8.0f} inserts/s'.format(
+            'commit per insert', run_clients(clients, per_client, direct)))
+
+        for delay_ms in (1, 5, 20):
+            writer = GroupCommitWriter(app, max_delay=delay_ms / 1000)
+            run = next(runs)
+
+            def grouped(name):
+                writer.submit(lambda: Actor(
+                    name='{} {}'.format(run, name), age=30, gender='F'))
+
+            print('{:<28} {:8.0f} inserts/s'.format(
+                'group commit, {} ms delay'.format(delay_ms),
+                run_clients(clients, per_client, grouped)))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,72 @@
+import sys
+import time
+from benchmarks import common  # noqa: F401 (sets the benchmark environment)
+from testing import LocalSigner
+
+'''
+JWT verification benchmark
+
+    Signs a token with a locally generated RSA key and reports verifies/sec
+    on one core for the old path (walk the JWKS, rebuild the rsa_key dict,
+    jose.jwt.decode) and for auth.verify_decode_jwt with the key registry,
+    using each available key backend.
+
+        python -m benchmarks.jwt_verify [seconds]
+'''
+
+
+def legacy_verify(token, jwks, config):
+    from jose import jwt
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return jwt.decode(
+        token, rsa_key, algorithms=config['ALGORITHMS'],
+        audience=config['API_AUDIENCE'],
+        issuer='https://' + config['AUTH0_DOMAIN'] + '/')
+
+
+def rate(fn, seconds):
+    done = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        fn()
+        done += 1
+    return done / seconds
+
+
+def main(seconds=3.0):
+    import auth
+
+    config = auth.auth_config()
+    signer = LocalSigner(kid='bench')
+    jwks = signer.jwks
+    token = signer.token(['get:actors'], sub='bench')
+
+    print('{:<28} {:10.0f} verifies/s'.format(
+        'jose, rebuilt key', rate(
+            lambda: legacy_verify(token, jwks, config), seconds)))
+    key_classes = [auth.JoseRSAKey]
+    if auth.public_key_class() is auth.CryptographyRSAKey:
+        key_classes.append(auth.CryptographyRSAKey)
+    else:
+        print('{:<28} skipped, cryptography is not installed'.format(
+            'registry, CryptographyRSAKey'))
+    for key_class in key_classes:
+        auth.public_key_class = lambda: key_class
+        auth._jwks_cache['registry_for'] = None
+        print('{:<28} {:10.0f} verifies/s'.format(
+            'registry, ' + key_class.__name__, rate(
+                lambda: auth.verify_decode_jwt(token), seconds)))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 3.0)
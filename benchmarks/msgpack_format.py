@@ -0,0 +1,57 @@
+import json
+import sys
+import time
+from benchmarks.common import bench_app
+
+'''
+MessagePack benchmark
+
+    Compares the GET /actors body in JSON and in MessagePack for ROWS
+    actors: its size, the time to encode it from the rows without and
+    with cached fragments, and the time a client takes to decode it.
+    Needs the msgpack package.
+
+        python -m benchmarks.msgpack_format [rows]
+'''
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(rows=100000):
+    app = bench_app(actors=rows)
+    import queries
+    from formats import msgpack
+    from rowcache import list_body, row_cache
+
+    if msgpack is None:
+        sys.exit('msgpack is not installed.')
+    with app.test_request_context():
+        selection = queries.all_actors()
+        decoders = {
+            'json': json.loads,
+            'msgpack': lambda body: msgpack.unpackb(body, raw=False)
+        }
+        print('{} rows'.format(rows))
+        print('{:8} {:>10} {:>12} {:>12} {:>12}'.format(
+            'format', 'MB', 'cold ms', 'warm ms', 'decode ms'))
+        decoded = []
+        for fmt, decode in decoders.items():
+            row_cache.clear()
+            cold, body = timed(lambda: list_body(
+                'actors', 'Actor', selection, fmt))
+            warm, body = timed(lambda: list_body(
+                'actors', 'Actor', selection, fmt))
+            decode_time, data = timed(lambda: decode(body))
+            decoded.append(data)
+            print('{:8} {:10.2f} {:12.1f} {:12.1f} {:12.1f}'.format(
+                fmt, len(body) / 1e6, cold * 1000, warm * 1000,
+                decode_time * 1000))
+        assert decoded[0] == decoded[1]
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,53 @@
+import sys
+from benchmarks.common import bench_app, per_call
+
+'''
+Query compilation benchmark
+
+    Compares the per-call cost of the ad hoc ORM queries the routes used to
+    build (Actor.query.filter(...), the Python duplicate-name loop) with the
+    baked queries in queries.py, on an in-memory SQLite database so the
+    numbers are dominated by ORM and SQL compilation overhead.
+
+        python -m benchmarks.query_compile [iterations]
+'''
+
+ROWS = 1000
+
+
+def main(iterations=5000):
+    app = bench_app(actors=ROWS)
+    import queries
+    from models import Actor
+
+    def legacy_by_id(i):
+        Actor.query.filter(Actor.id == i % ROWS + 1).one_or_none()
+
+    def baked_by_id(i):
+        queries.actor_by_id(i % ROWS + 1)
+
+    def legacy_name_taken(i):
+        name = 'actor {}'.format(i % ROWS)
+        for actor in Actor.query.all():
+            if actor.name.upper() == name.upper():
+                return True
+        return False
+
+    def baked_name_taken(i):
+        queries.actor_name_taken('actor {}'.format(i % ROWS))
+
+    cases = [
+        ('select by id', legacy_by_id, baked_by_id, iterations),
+        ('duplicate name check', legacy_name_taken, baked_name_taken,
+         max(iterations // 100, 10)),
+    ]
+    with app.app_context():
+        for label, legacy, baked, runs in cases:
+            before = per_call(legacy, runs)
+            after = per_call(baked, runs)
+            print('{:<22} before: {:8.1f} us   after: {:8.1f} us'
+                  .format(label, before * 1e6, after * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,67 @@
+import sys
+import tracemalloc
+from benchmarks.common import bench_app
+
+'''
+Row memory benchmark
+
+    Measures with tracemalloc the peak memory per row of building the
+    GET /actors body for ROWS actors:
+
+        orm + dicts   ORM instances, format() dicts and jsonify
+        orm           ORM instances and cached fragments (rowcache)
+        rows          column tuples (queries.actor_rows) and fragments
+
+    The row cache is cleared before each run, so the fragments are
+    counted every time.
+
+        python -m benchmarks.row_memory [rows]
+'''
+
+
+def peak(fn):
+    # Peak bytes allocated while fn runs. Tracing starts afresh each time,
+    # so only fn's own allocations are counted.
+    tracemalloc.start()
+    result = fn()
+    top = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return top, result
+
+
+def main(rows=100000):
+    app = bench_app(actors=rows)
+    import queries
+    from flask import jsonify
+    from models import db
+    from rowcache import list_body, row_cache
+
+    def orm_dicts():
+        selection = queries.all_actors()
+        return jsonify({
+            'success': True,
+            'actors': [actor.format() for actor in selection]
+        }).get_data()
+
+    def orm():
+        return list_body('actors', 'Actor', queries.all_actors())
+
+    def column_rows():
+        return list_body('actors', 'Actor', queries.actor_rows())
+
+    print('{} rows'.format(rows))
+    bodies = []
+    for name, build in (('orm + dicts', orm_dicts), ('orm', orm),
+                        ('rows', column_rows)):
+        with app.test_request_context():
+            row_cache.clear()
+            used, body = peak(build)
+            db.session.remove()
+        bodies.append(body)
+        print('{:12} {:8.0f} bytes/row  ({:.1f} MB peak)'.format(
+            name, used / rows, used / 1e6))
+    assert bodies[0] == bodies[1] == bodies[2]
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
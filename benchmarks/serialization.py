@@ -0,0 +1,52 @@
+import sys
+import time
+from benchmarks.common import bench_app
+
+'''
+Serialization benchmark
+
+    Times building the GET /movies body for ROWS rows with jsonify over
+    Movie.format() and by joining cached JSON fragments from rowcache, both
+    with an empty cache (first request) and a warm one.
+
+        python -m benchmarks.serialization [rows]
+'''
+
+
+def timed(fn):
+    start = time.perf_counter()
+    body = fn()
+    return time.perf_counter() - start, body
+
+
+def main(rows=100000):
+    app = bench_app(movies=rows)
+    import queries
+    from flask import jsonify
+    from rowcache import list_body, row_cache
+
+    with app.test_request_context():
+        selection = queries.all_movies()
+
+        def with_jsonify():
+            return jsonify({
+                'success': True,
+                'movies': [movie.format() for movie in selection]
+            }).get_data()
+
+        def with_fragments():
+            return list_body('movies', 'Movie', selection)
+
+        row_cache.clear()
+        before, expected = timed(with_jsonify)
+        cold, body = timed(with_fragments)
+        warm, body = timed(with_fragments)
+        assert body == expected
+        print('{} rows, {:.1f} MB body'.format(rows, len(body) / 1e6))
+        print('jsonify + format():  {:8.1f} ms'.format(before * 1000))
+        print('fragments, cold:     {:8.1f} ms'.format(cold * 1000))
+        print('fragments, warm:     {:8.1f} ms'.format(warm * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
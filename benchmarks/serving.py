@@ -0,0 +1,109 @@
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from urllib.request import Request, urlopen
+
+'''
+Serving benchmark
+
+    Starts gunicorn with its defaults (the old Procfile) and with
+    gunicorn.conf.py at increasing worker counts, drives each with
+    concurrent keep-alive-free HTTP clients and prints requests/sec.
+
+    Run from the main project directory with the usual environment set:
+
+        source setup.sh
+        BENCH_TOKEN=<token> python -m benchmarks.serving --path /actors
+
+    --workers takes a comma separated list of worker counts to try with
+    the tuned configuration, it defaults to 1, 2, 4 ... up to the number
+    of cores.
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def client(url, token, deadline, counts):
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+    done = errors = 0
+    while time.time() < deadline:
+        try:
+            urlopen(Request(url, headers=headers)).read()
+            done += 1
+        except Exception:
+            errors += 1
+    counts.put((done, errors))
+
+
+def drive(url, token, clients, duration):
+    counts = multiprocessing.Queue()
+    deadline = time.time() + duration
+    procs = [
+        multiprocessing.Process(
+            target=client, args=(url, token, deadline, counts))
+        for _ in range(clients)
+    ]
+    for proc in procs:
+        proc.start()
+    results = [counts.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return (sum(done for done, _ in results) / duration,
+            sum(errors for _, errors in results))
+
+
+def wait_until_up(url, token, timeout=30):
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(Request(url, headers=headers)).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not come up on ' + url)
+
+
+def run(label, args, env, options):
+    url = 'http://127.0.0.1:{}{}'.format(options.port, options.path)
+    cmd = [sys.executable, '-m', 'gunicorn', '--bind',
+           '127.0.0.1:{}'.format(options.port)] + args + ['app:app']
+    server = subprocess.Popen(cmd, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(url, options.token)
+        rps, errors = drive(url, options.token, options.clients,
+                            options.duration)
+        print('{:<24} {:10.1f} req/s  ({} errors)'.format(label, rps, errors))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='/actors')
+    parser.add_argument('--token', default=os.environ.get('BENCH_TOKEN'))
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--clients', type=int, default=cores * 4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', default=','.join(
+        str(n) for n in sorted({2 ** i for i in range(8) if 2 ** i <= cores}
+                               | {cores})))
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    run('default', [], env, options)
+    for workers in options.workers.split(','):
+        env = dict(os.environ, WEB_CONCURRENCY=workers)
+        run('tuned, {} workers'.format(workers),
+            ['--config', 'gunicorn.conf.py'], env, options)
+
+
+if __name__ == '__main__':
+    main()
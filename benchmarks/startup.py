@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+'''
+Startup benchmark
+
+    Measures, in fresh interpreters, how long it takes to import app.py
+    and to build an application with create_app(), once with the schema
+    created by db.create_all() and once with schema work left to the
+    migrations (DB_CREATE_ALL=false).
+
+    Run from the main project directory:
+
+        python -m benchmarks.startup [runs]
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_APP = (
+    "import time; t = time.perf_counter(); import app; "
+    "print(time.perf_counter() - t)"
+)
+CREATE_APP = (
+    "from app import create_app; import time; t = time.perf_counter(); "
+    "create_app(); print(time.perf_counter() - t)"
+)
+
+
+def bench_env(database_url, create_all):
+    env = dict(os.environ)
+    env.setdefault('AUTH0_DOMAIN', 'example.auth0.com')
+    env.setdefault('ALGORITHMS', 'RS256')
+    env.setdefault('API_AUDIENCE', 'capstoneCastingAPI')
+    env['DATABASE_URL'] = database_url
+    env['DB_CREATE_ALL'] = 'true' if create_all else 'false'
+    return env
+
+
+def time_process(code, env, runs):
+    # Each sample is timed inside a fresh interpreter, so the interpreter's
+    # own startup is excluded and every run sees cold module caches.
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True
+            )
+        samples.append(float(result.stdout.split()[-1]))
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main(runs=10):
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'startup.db')
+        for create_all in (True, False):
+            env = bench_env(database_url, create_all)
+            mode = 'create_all' if create_all else 'migrations'
+            import_time = time_process(IMPORT_APP, env, runs)
+            boot_time = time_process(CREATE_APP, env, runs)
+            print('{:<11} import app: {:7.1f} ms   create_app(): {:7.1f} ms'
+                  .format(mode, import_time * 1000, boot_time * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
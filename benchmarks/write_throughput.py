@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import time
+from benchmarks.common import bench_app
+
+'''
+Write throughput benchmark
+
+    Inserts ROWS actors into a file-backed SQLite database, once with the
+    default commit per insert() and once inside models.unit_of_work(), and
+    prints rows/sec for each.
+
+        python -m benchmarks.write_throughput [rows]
+'''
+
+
+def main(rows=2000):
+    from models import Actor, unit_of_work
+
+    def insert_rows(prefix):
+        for i in range(rows):
+            Actor(name='{} {}'.format(prefix, i), age=30, gender='F').insert()
+
+    def grouped(prefix):
+        with unit_of_work():
+            insert_rows(prefix)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app('sqlite:///' + os.path.join(tmp, 'writes.db'))
+        with app.app_context():
+            for label, write in (('commit per row', insert_rows),
+                                 ('unit_of_work', grouped)):
+                start = time.perf_counter()
+                write(label)
+                elapsed = time.perf_counter() - start
+                print('{:<16} {:10.0f} rows/s'.format(label, rows / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
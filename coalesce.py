@@ -0,0 +1,47 @@
+import threading
+
+'''
+Request coalescing
+
+    SingleFlight.do(key, fn) runs fn once for any number of threads that ask
+    for the same key at the same time: the first caller runs it, the others
+    wait and receive its result (or its exception). Nothing is kept once the
+    call finishes, so a later caller always runs fn again.
+'''
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
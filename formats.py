@@ -0,0 +1,61 @@
+from flask import abort, current_app, jsonify, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+'''
+Response formats
+
+    Routes answer in JSON, or in MessagePack when the client sends
+    Accept: application/msgpack (application/x-msgpack is accepted too),
+    and read request bodies sent as either. MessagePack is optional: when
+    the msgpack package is not installed every response is JSON and
+    MessagePack bodies are rejected with 400.
+
+    respond(data) replaces jsonify(data) and request_body() replaces
+    request.get_json() in the views. Every response carries Vary: Accept,
+    set by vary_on_accept, so shared caches keep the formats apart.
+'''
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+MSGPACK_TYPES = (MSGPACK, 'application/x-msgpack')
+
+MIMETYPES = {'json': JSON, 'msgpack': MSGPACK}
+
+
+def response_format():
+    # 'msgpack' if the client prefers it and it is available, else 'json'.
+    if msgpack is None:
+        return 'json'
+    best = request.accept_mimetypes.best_match((JSON,) + MSGPACK_TYPES)
+    return 'msgpack' if best in MSGPACK_TYPES else 'json'
+
+
+def packb(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def respond(data):
+    if response_format() == 'msgpack':
+        return current_app.response_class(packb(data), mimetype=MSGPACK)
+    return jsonify(data)
+
+
+def vary_on_accept(response):
+    # after_request hook, it also runs for the error handlers' responses.
+    response.vary.add('Accept')
+    return response
+
+
+def request_body():
+    if request.mimetype not in MSGPACK_TYPES:
+        return request.get_json()
+    if msgpack is None:
+        abort(400)
+    try:
+        return msgpack.unpackb(request.get_data(), raw=False)
+    except Exception:
+        abort(400)
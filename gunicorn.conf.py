@@ -0,0 +1,47 @@
+import gc
+import multiprocessing
+import os
+
+'''
+Gunicorn production settings
+
+    The application is imported once in the master process (preload_app)
+    and auth.warm_up() loads the JWT libraries and the JWKS before the
+    workers are forked, so that state is shared copy-on-write. Workers are
+    recycled after max_requests to bound memory growth, and are given
+    graceful_timeout seconds to finish in-flight requests on restart.
+
+    Every setting can be overridden from the environment, e.g. Heroku's
+    WEB_CONCURRENCY sets the number of worker processes.
+'''
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+cores = multiprocessing.cpu_count()
+
+preload_app = True
+workers = env_int('WEB_CONCURRENCY', cores * 2 + 1)
+threads = env_int('GUNICORN_THREADS', 2)
+worker_class = 'gthread' if threads > 1 else 'sync'
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+timeout = env_int('GUNICORN_TIMEOUT', 30)
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+
+
+def when_ready(server):
+    import auth
+    auth.warm_up()
+    # Move everything allocated so far out of the collector's reach, so
+    # gc passes in the workers don't touch (and copy) the shared pages.
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from models import dispose_engines
+    dispose_engines()
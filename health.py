@@ -0,0 +1,150 @@
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Health and readiness
+
+    GET /healthz answers as long as the worker can serve a request, without
+    touching the database or Auth0, for liveness probes.
+
+    GET /readyz answers 503 when the worker should be taken out of the load
+    balancer: the database did not answer its last ping, or no JWKS is
+    loaded to verify tokens with, or, when READY_MAX_DB_LATENCY_MS is set,
+    the database's p95 ping latency is above it. The database is pinged at
+    most every READY_DB_CHECK_SECONDS (default 5) per worker, probes in
+    between reuse the last result. A worker without a JWKS, because
+    warm_up failed or no request has needed one yet, fetches it from a
+    probe, at most every READY_JWKS_RETRY_SECONDS (default 5). The
+    response also reports the
+    connection pool, the JWKS age and the rolling database and Auth0
+    (JWKS download) latencies.
+'''
+
+
+class RollingLatency:
+    # The last size timings, in seconds.
+    def __init__(self, size=100):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {'count': 0, 'p50_ms': None, 'p95_ms': None,
+                    'max_ms': None}
+
+        def percentile(fraction):
+            index = min(len(samples) - 1, int(len(samples) * fraction))
+            return round(samples[index] * 1000, 2)
+        return {
+            'count': len(samples),
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(samples[-1] * 1000, 2)
+        }
+
+
+class DatabaseCheck:
+    def __init__(self, engine, interval=5.0):
+        self.engine = engine
+        self.interval = interval
+        self.latency = RollingLatency()
+        self._lock = threading.Lock()
+        self._last = None
+
+    def status(self):
+        # Ping when the last result is older than interval. While one
+        # thread pings, the others return the last result instead of
+        # piling up on the database.
+        last = self._last
+        due = last is None or time.time() - last['checked_at'] >= \
+            self.interval
+        if due and self._lock.acquire(blocking=last is None):
+            try:
+                if self._last is last:
+                    self._last = self.ping()
+            finally:
+                self._lock.release()
+        return dict(self._last)
+
+    def ping(self):
+        started = time.perf_counter()
+        try:
+            with self.engine.connect() as connection:
+                connection.execute('SELECT 1')
+        except Exception as error:
+            ok, message = False, error.__class__.__name__
+        else:
+            ok, message = True, None
+        elapsed = time.perf_counter() - started
+        if ok:
+            self.latency.record(elapsed)
+        return {
+            'ok': ok,
+            'error': message,
+            'checked_at': time.time(),
+            'ping_ms': round(elapsed * 1000, 2),
+            'pool': self.engine.pool.status()
+        }
+
+
+class JwksCheck:
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._attempted_at = None
+        self._error = None
+
+    def status(self):
+        # The JWKS status, after trying to fetch a missing JWKS when the
+        # last attempt is older than interval. One thread fetches, the
+        # others report the JWKS as not loaded meanwhile.
+        import auth
+        status = auth.jwks_status()
+        if status['loaded']:
+            return status
+        last = self._attempted_at
+        due = last is None or time.time() - last >= self.interval
+        if due and self._lock.acquire(blocking=False):
+            try:
+                self._attempted_at = time.time()
+                auth.key_registry()
+                self._error = None
+            except Exception as error:
+                logger.warning('Unable to load the JWKS.', exc_info=True)
+                self._error = error.__class__.__name__
+            finally:
+                self._lock.release()
+            status = auth.jwks_status()
+        if not status['loaded']:
+            status['error'] = self._error
+        return status
+
+
+def readiness(db_check, jwks_check):
+    # return (ready, checks) for GET /readyz
+    import auth
+    database = db_check.status()
+    database['checked_seconds_ago'] = round(
+        time.time() - database.pop('checked_at'), 1)
+    database['latency'] = db_check.latency.summary()
+    jwks = jwks_check.status()
+    jwks['latency'] = auth.jwks_latency.summary()
+
+    ready = database['ok'] and jwks['loaded']
+    max_latency = os.environ.get('READY_MAX_DB_LATENCY_MS')
+    p95 = database['latency']['p95_ms']
+    if max_latency is not None and p95 is not None and \
+            p95 > float(max_latency):
+        ready = False
+    return ready, {'database': database, 'jwks': jwks}
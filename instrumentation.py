@@ -0,0 +1,140 @@
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Query instrumentation
+
+    With QUERY_INSTRUMENTATION=true (in the app config or the environment)
+    every SQL statement a request runs, on the primary or a replica, is
+    counted through SQLAlchemy engine events. Responses then carry
+    X-Query-Count and X-Query-Time-Ms headers.
+
+    A view decorated with query_budget(n) declares the most queries it may
+    run. A request that runs more logs a warning and is recorded in
+    budget_violations(app); test_app.py fails any test that leaves one.
+
+    SLOW_QUERY_MS logs every statement slower than that many milliseconds
+    together with its EXPLAIN plan. Setting it turns instrumentation on.
+    Nothing is hooked into the engines while both are off.
+'''
+
+
+def query_budget(max_queries):
+    # Declares the most queries a view may run per request. The attribute
+    # is set on the function registered with the app, where check_budget
+    # looks it up, so apply it directly below @app.route.
+    def decorator(f):
+        f.query_budget = max_queries
+        return f
+    return decorator
+
+
+def config_value(app, name, default=None):
+    return app.config.get(name, os.environ.get(name, default))
+
+
+def enabled(app):
+    value = config_value(app, 'QUERY_INSTRUMENTATION', 'false')
+    return str(value).lower() in ('1', 'true', 'yes', 'on') or \
+        config_value(app, 'SLOW_QUERY_MS') is not None
+
+
+class QueryStats:
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.violations = []
+        self._lock = threading.Lock()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        context._query_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        elapsed = time.perf_counter() - context._query_started
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+            g.query_time = g.get('query_time', 0.0) + elapsed
+        if self.slow_query_ms is not None and \
+                elapsed * 1000 >= self.slow_query_ms:
+            logger.warning(
+                'Slow query (%.1f ms): %s\nParameters: %r\nPlan:\n%s',
+                elapsed * 1000, statement, parameters,
+                explain(conn, statement, parameters, executemany))
+
+    def start_request(self):
+        # g outlives the request when an app context was already pushed.
+        g.query_count = 0
+        g.query_time = 0.0
+
+    def check_budget(self, response):
+        # Called after each request, adds the query headers and records a
+        # view that went over its budget.
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+        response.headers['X-Query-Time-Ms'] = '{:.1f}'.format(
+            g.get('query_time', 0.0) * 1000)
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and count > budget:
+            violation = (request.method, request.full_path, count, budget)
+            logger.warning('%s %s ran %d queries, over its budget of %d.',
+                           *violation)
+            with self._lock:
+                self.violations.append(violation)
+        return response
+
+
+def explain(conn, statement, parameters, executemany):
+    # The plan of a slow SELECT, read on a raw cursor of the same
+    # connection so the EXPLAIN itself is not instrumented.
+    if executemany or not statement.lstrip().upper().startswith('SELECT'):
+        return '(no plan)'
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' \
+        else 'EXPLAIN '
+    try:
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join(
+                ' '.join(str(column) for column in row)
+                for row in cursor.fetchall())
+        finally:
+            cursor.close()
+    except Exception as error:
+        return '(EXPLAIN failed: {})'.format(error)
+
+
+'''
+install(app, engines)
+    hooks the engines and the app's requests when instrumentation is
+    enabled. return the QueryStats, or None when it is off
+'''
+
+
+def install(app, engines):
+    if not enabled(app):
+        return None
+    slow_query_ms = config_value(app, 'SLOW_QUERY_MS')
+    stats = QueryStats(
+        None if slow_query_ms is None else float(slow_query_ms))
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute',
+                     stats.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     stats.after_cursor_execute)
+    app.before_request(stats.start_request)
+    app.after_request(stats.check_budget)
+    app.extensions['query_stats'] = stats
+    return stats
+
+
+def budget_violations(app):
+    stats = app.extensions.get('query_stats')
+    return [] if stats is None else list(stats.violations)
@@ -0,0 +1,416 @@
+from sqlalchemy import extract, func
+from models import db, dispose_engines, unit_of_work, Actor, Movie, Job
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import queries
+import tenants
+
+logger = logging.getLogger(__name__)
+
+'''
+Background jobs
+
+    Imports, exports and statistics over the whole database take too long
+    to run inside a web request. POST /jobs stores them in the Job table
+    instead, and a pool of worker processes, started with
+    `python manage.py worker`, claims queued jobs and runs them, so
+    gunicorn workers stay free for interactive requests and bulk work runs
+    on other cores, or on another dyno.
+
+    A job reports its progress after every JOB_CHUNK_SIZE rows (default
+    500), each chunk of an import being committed in one transaction.
+    Clients poll GET /jobs/<id> for the status and result. Jobs run on the
+    data of the tenant that submitted them (see tenants.py). DELETE
+    /jobs/<id> cancels a queued job at once, and a running job at its next
+    progress report, keeping the chunks it has already committed.
+
+    JOB_WORKERS (default the number of CPUs) sets the number of worker
+    processes and JOB_POLL_SECONDS (default 1) how often an idle worker
+    looks for new jobs.
+
+    A running job holds a lease: its worker refreshes heartbeat_at every
+    JOB_HEARTBEAT_SECONDS (default 10). A job whose heartbeat is older than
+    JOB_LEASE_SECONDS (default 60), because its worker was killed, is
+    failed, or cancelled if it was being cancelled, by the next worker that
+    looks for a job.
+'''
+
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 500))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', 10))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+
+# A job in one of these states will not change any more.
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# kind: (handler, permissions needed to submit the job)
+JOB_KINDS = {}
+
+
+def job_kind(kind, *permissions):
+    def register(handler):
+        JOB_KINDS[kind] = (handler, permissions)
+        return handler
+    return register
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def submit(kind, params, submitted_by, tenant=None):
+    job = Job(kind, params, submitted_by, tenant)
+    job.insert()
+    return job
+
+
+'''
+cancel(job)
+    cancels a queued job straight away and asks a running one to stop.
+    return False when the job had already finished
+'''
+
+
+def cancel(job):
+    session = db.session()
+    for current, new in (('queued', 'cancelled'), ('running', 'cancelling')):
+        updated = session.query(Job).filter(
+            Job.id == job.id, Job.status == current
+            ).update({'status': new, 'updated_at': utcnow()},
+                     synchronize_session=False)
+        if updated:
+            session.commit()
+            return True
+    session.commit()
+    return False
+
+
+def expire_stale(session):
+    # Ends the jobs whose worker stopped sending heartbeats. Jobs claimed
+    # before heartbeats existed fall back to updated_at.
+    cutoff = utcnow() - datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+    last_seen = func.coalesce(Job.heartbeat_at, Job.updated_at)
+    for current, values in (
+            ('running', {'status': 'failed',
+                         'error': 'The job worker stopped.'}),
+            ('cancelling', {'status': 'cancelled'})):
+        values['updated_at'] = utcnow()
+        session.query(Job).filter(
+            Job.status == current, last_seen < cutoff
+            ).update(values, synchronize_session=False)
+    session.commit()
+
+
+def claim_next():
+    # Marks the oldest queued job as running and returns it, or None when
+    # the queue is empty. The conditional UPDATE lets only one worker win
+    # a job that several of them picked at the same time.
+    session = db.session()
+    expire_stale(session)
+    while True:
+        job = session.query(Job).filter(
+            Job.status == 'queued').order_by(Job.id).first()
+        if job is None:
+            return None
+        claimed = session.query(Job).filter(
+            Job.id == job.id, Job.status == 'queued'
+            ).update({'status': 'running', 'updated_at': utcnow(),
+                      'heartbeat_at': utcnow()},
+                     synchronize_session=False)
+        session.commit()
+        if claimed:
+            return job
+
+
+def report_progress(job, done, total=None):
+    # Commits the job's progress, raise JobCancelled if it was cancelled.
+    session = db.session()
+    values = {'progress': done, 'updated_at': utcnow(),
+              'heartbeat_at': utcnow()}
+    if total is not None:
+        values['total'] = total
+    session.query(Job).filter(Job.id == job.id).update(
+        values, synchronize_session=False)
+    status = session.query(Job.status).filter(Job.id == job.id).scalar()
+    session.commit()
+    if status == 'cancelling':
+        raise JobCancelled()
+
+
+def finish(job, status, result=None, error=None):
+    session = db.session()
+    session.query(Job).filter(
+        Job.id == job.id, Job.status.in_(('running', 'cancelling'))
+        ).update({
+            'status': status,
+            'result': None if result is None else json.dumps(result),
+            'error': error,
+            'updated_at': utcnow()
+        }, synchronize_session=False)
+    session.commit()
+
+
+class Heartbeat:
+    # Refreshes a running job's heartbeat_at from a background thread, so
+    # the lease holds while the handler is busy between progress reports.
+    # It uses its own connections, not the handler's session.
+    def __init__(self, engine, job_id, interval=JOB_HEARTBEAT_SECONDS):
+        self.engine = engine
+        self.job_id = job_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='job-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        Job.__table__.update().where(
+                            Job.__table__.c.id == self.job_id
+                            ).values(heartbeat_at=utcnow()))
+            except Exception:
+                logger.warning('Heartbeat of job %d failed.', self.job_id,
+                               exc_info=True)
+
+
+def run(job):
+    # The handler reads and writes the data of the job's tenant, the Job
+    # row itself stays in DATABASE_URL.
+    handler = JOB_KINDS.get(job.kind, (None, ()))[0]
+    try:
+        if handler is None:
+            raise ValueError('Unknown job kind {}.'.format(job.kind))
+        with Heartbeat(db.get_engine(), job.id), tenants.using(job.tenant):
+            result = handler(job, json.loads(job.params))
+    except JobCancelled:
+        db.session.rollback()
+        finish(job, 'cancelled')
+    except Exception as error:
+        logger.exception('Job %d failed.', job.id)
+        db.session.rollback()
+        finish(job, 'failed', error=str(error))
+    else:
+        finish(job, 'done', result)
+
+
+def run_next():
+    # Runs the oldest queued job, call inside an app context.
+    job = claim_next()
+    if job is not None:
+        run(job)
+    return job
+
+
+def chunks(rows):
+    for start in range(0, len(rows), JOB_CHUNK_SIZE):
+        yield start, rows[start:start + JOB_CHUNK_SIZE]
+
+
+# Jobs
+
+
+@job_kind('import_actors', 'post:actors')
+def import_actors(job, params):
+    rows = params.get('actors', [])
+    imported, skipped, seen = 0, [], set()
+    report_progress(job, 0, len(rows))
+    for start, chunk in chunks(rows):
+        taken = queries.actor_names_taken(
+            [row['name'] for row in chunk
+             if isinstance(row, dict) and isinstance(row.get('name'), str)])
+        with unit_of_work():
+            for index, row in enumerate(chunk, start):
+                actor = actor_from_row(row)
+                if actor is None or actor.name.upper() in taken \
+                        or actor.name.upper() in seen:
+                    skipped.append(index)
+                    continue
+                seen.add(actor.name.upper())
+                actor.insert()
+                imported += 1
+        report_progress(job, start + len(chunk))
+    return {'imported': imported, 'skipped': skipped}
+
+
+def actor_from_row(row):
+    # The same checks as POST /actors, None if the row is not valid.
+    if not isinstance(row, dict):
+        return None
+    name, age, gender = row.get('name'), row.get('age'), row.get('gender')
+    if not isinstance(name, str) or not isinstance(gender, str) \
+            or not isinstance(age, int):
+        return None
+    if gender.upper() not in ('M', 'F'):
+        return None
+    return Actor(name=name, age=age, gender=gender.upper())
+
+
+@job_kind('import_movies', 'post:movies')
+def import_movies(job, params):
+    rows = params.get('movies', [])
+    imported, skipped, seen = 0, [], set()
+    report_progress(job, 0, len(rows))
+    for start, chunk in chunks(rows):
+        taken = queries.movie_titles_taken(
+            [row['title'] for row in chunk
+             if isinstance(row, dict) and isinstance(row.get('title'), str)])
+        with unit_of_work():
+            for index, row in enumerate(chunk, start):
+                movie = movie_from_row(row)
+                if movie is None or movie.title.upper() in taken \
+                        or movie.title.upper() in seen:
+                    skipped.append(index)
+                    continue
+                seen.add(movie.title.upper())
+                movie.insert()
+                imported += 1
+        report_progress(job, start + len(chunk))
+    return {'imported': imported, 'skipped': skipped}
+
+
+def movie_from_row(row):
+    # The same checks as POST /movies, None if the row is not valid.
+    from app import parse_date
+    if not isinstance(row, dict):
+        return None
+    title, release_date = row.get('title'), row.get('release_date')
+    if not isinstance(title, str) or not isinstance(release_date, str):
+        return None
+    release_date = parse_date(release_date)
+    if release_date is None:
+        return None
+    return Movie(title=title, release_date=release_date)
+
+
+@job_kind('export_actors', 'get:actors')
+def export_actors(job, params):
+    actors = queries.actor_rows()
+    report_progress(job, 0, len(actors))
+    exported = []
+    for start, chunk in chunks(actors):
+        exported.extend(actor.format() for actor in chunk)
+        report_progress(job, start + len(chunk))
+    return {'actors': exported}
+
+
+@job_kind('export_movies', 'get:movies')
+def export_movies(job, params):
+    movies = queries.movie_rows()
+    report_progress(job, 0, len(movies))
+    exported = []
+    for start, chunk in chunks(movies):
+        exported.extend(movie.format() for movie in chunk)
+        report_progress(job, start + len(chunk))
+    return {'movies': exported}
+
+
+@job_kind('stats', 'get:actors', 'get:movies')
+def stats(job, params):
+    session = db.session()
+    report_progress(job, 0, 3)
+    actors, average_age = session.query(
+        func.count(Actor.id), func.avg(Actor.age)).one()
+    genders = session.query(
+        Actor.gender, func.count(Actor.id)).group_by(Actor.gender).all()
+    report_progress(job, 2)
+    year = extract('year', Movie.release_date)
+    per_year = session.query(
+        year, func.count(Movie.id)).group_by(year).order_by(year).all()
+    report_progress(job, 3)
+    return {
+        'actors': actors,
+        'average_age': None if average_age is None else float(average_age),
+        'genders': {gender: count for gender, count in genders},
+        'movies': sum(count for _, count in per_year),
+        'movies_per_year': {str(int(y)): count for y, count in per_year}
+    }
+
+
+# Worker pool
+
+
+def work(app, stop, poll_interval=1.0):
+    # Runs jobs until stop is set, waiting poll_interval seconds whenever
+    # the queue is empty. A job in progress is finished before returning.
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                job = run_next()
+            except Exception:
+                logger.exception('Job worker failed.')
+                job = None
+            finally:
+                db.session.remove()
+            if job is None:
+                stop.wait(poll_interval)
+
+
+def worker_main(app, stop, poll_interval):
+    # Connections inherited from the parent must not be shared.
+    dispose_engines()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    work(app, stop, poll_interval)
+
+
+'''
+run_pool(app)
+    starts the worker processes and keeps one running per slot, restarting
+    any that dies, until SIGTERM or SIGINT. Workers finish their current
+    job before exiting.
+'''
+
+
+def run_pool(app, processes=None, poll_interval=None):
+    if processes is None:
+        processes = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+    if poll_interval is None:
+        poll_interval = float(os.environ.get('JOB_POLL_SECONDS', 1))
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        stopping.set()
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def start():
+        process = context.Process(
+            target=worker_main, args=(app, stop, poll_interval),
+            name='job-worker')
+        process.start()
+        return process
+
+    pool = [start() for _ in range(processes)]
+    logger.info('Started %d job workers.', processes)
+    while not stopping.is_set():
+        stopping.wait(1)
+        for slot, process in enumerate(pool):
+            if not process.is_alive() and not stopping.is_set():
+                logger.warning('Job worker %d exited, restarting it.',
+                               process.pid)
+                pool[slot] = start()
+    for process in pool:
+        process.join()
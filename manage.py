@@ -3,6 +3,8 @@ from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+import jobs
+import partitions
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +12,44 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-p', '--processes', dest='processes', type=int,
+                default=None, help='Number of job worker processes.')
+def worker(processes):
+    # Run the background job workers (see jobs.py).
+    jobs.run_pool(app, processes)
+
+
+@manager.option('-a', '--ahead', dest='ahead', type=int, default=2,
+                help='Years ahead of this one to create partitions for.')
+def add_partitions(ahead):
+    # Add the Movie partitions of the coming years (see partitions.py).
+    with db.engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            print('Movie is not partitioned.')
+            return
+        for name in partitions.ensure_partitions(connection, ahead):
+            print('Created {}.'.format(name))
+
+
+@manager.option('-b', '--before', dest='before', type=int, required=True,
+                help='Archive the releases before this year.')
+@manager.option('-t', '--tablespace', dest='tablespace', default=None,
+                help='Move the archived partitions to this tablespace.')
+@manager.option('-d', '--detach', dest='detach', action='store_true',
+                help='Detach the archived partitions from Movie.')
+def archive(before, tablespace, detach):
+    # Move the Movie partitions of old releases to cold storage.
+    if tablespace is None and not detach:
+        print('Give a --tablespace, --detach or both.')
+        return
+    with db.engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            print('Movie is not partitioned.')
+            return
+        for name in partitions.archive(
+                connection, before, tablespace, detach):
+            print('Archived {}.'.format(name))
+
+
 if __name__ == '__main__':
     manager.run()
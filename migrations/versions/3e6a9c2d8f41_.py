@@ -0,0 +1,92 @@
+"""partition Movie by release date
+
+Revision ID: 3e6a9c2d8f41
+Revises: 9b2e5d1c4a7f
+Create Date: 2026-10-19 14:00:00.000000
+
+On Postgres the Movie table is rebuilt as a table range partitioned on
+release_date, see partitions.py. Other databases only get the
+release_date index.
+
+"""
+from alembic import op
+import datetime
+
+
+# revision identifiers, used by Alembic.
+revision = '3e6a9c2d8f41'
+down_revision = '9b2e5d1c4a7f'
+branch_labels = None
+depends_on = None
+
+FIRST_PARTITION_YEAR = 1990
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index(
+            op.f('ix_Movie_release_date'), 'Movie', ['release_date'])
+        return
+
+    op.execute('ALTER TABLE "Movie" RENAME TO "Movie_unpartitioned"')
+    op.execute('ALTER TABLE "Movie_unpartitioned" '
+               'RENAME CONSTRAINT "Movie_pkey" TO "Movie_unpartitioned_pkey"')
+    # The partition key has to be part of the primary key, ids stay unique
+    # through the sequence.
+    op.execute('''
+        CREATE TABLE "Movie" (
+            id integer NOT NULL
+                DEFAULT nextval('"Movie_id_seq"'::regclass),
+            title character varying NOT NULL,
+            release_date date NOT NULL,
+            version integer DEFAULT 1 NOT NULL,
+            CONSTRAINT "Movie_pkey" PRIMARY KEY (id, release_date)
+        ) PARTITION BY RANGE (release_date)
+    ''')
+    op.execute('CREATE INDEX "ix_Movie_release_date" '
+               'ON "Movie" (release_date)')
+    op.execute('''
+        CREATE TABLE "Movie_old" PARTITION OF "Movie"
+            FOR VALUES FROM (MINVALUE) TO ('{}-01-01')
+    '''.format(FIRST_PARTITION_YEAR))
+    for year in range(FIRST_PARTITION_YEAR,
+                      datetime.date.today().year + 3):
+        op.execute('''
+            CREATE TABLE "Movie_y{0}" PARTITION OF "Movie"
+                FOR VALUES FROM ('{0}-01-01') TO ('{1}-01-01')
+        '''.format(year, year + 1))
+    op.execute('CREATE TABLE "Movie_default" PARTITION OF "Movie" DEFAULT')
+
+    op.execute('INSERT INTO "Movie" (id, title, release_date, version) '
+               'SELECT id, title, release_date, version '
+               'FROM "Movie_unpartitioned"')
+    op.execute('ALTER SEQUENCE "Movie_id_seq" OWNED BY "Movie".id')
+    op.execute('DROP TABLE "Movie_unpartitioned"')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.drop_index(op.f('ix_Movie_release_date'), table_name='Movie')
+        return
+
+    # Partitions detached into the archive schema are left untouched.
+    op.execute('ALTER TABLE "Movie" RENAME TO "Movie_partitioned"')
+    op.execute('ALTER TABLE "Movie_partitioned" '
+               'RENAME CONSTRAINT "Movie_pkey" TO "Movie_partitioned_pkey"')
+    op.execute('ALTER INDEX "ix_Movie_release_date" '
+               'RENAME TO "ix_Movie_partitioned_release_date"')
+    op.execute('''
+        CREATE TABLE "Movie" (
+            id integer NOT NULL
+                DEFAULT nextval('"Movie_id_seq"'::regclass),
+            title character varying NOT NULL,
+            release_date date NOT NULL,
+            version integer DEFAULT 1 NOT NULL,
+            CONSTRAINT "Movie_pkey" PRIMARY KEY (id)
+        )
+    ''')
+    op.execute('INSERT INTO "Movie" (id, title, release_date, version) '
+               'SELECT id, title, release_date, version '
+               'FROM "Movie_partitioned"')
+    op.execute('ALTER SEQUENCE "Movie_id_seq" OWNED BY "Movie".id')
+    op.execute('DROP TABLE "Movie_partitioned"')
@@ -0,0 +1,24 @@
+"""add tenant to background jobs
+
+Revision ID: 5d8b1f3e7a26
+Revises: 3e6a9c2d8f41
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8b1f3e7a26'
+down_revision = '3e6a9c2d8f41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Job', sa.Column('tenant', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('Job', 'tenant')
@@ -0,0 +1,28 @@
+"""add row version columns
+
+Revision ID: 7c1f4a2be3d9
+Revises: 54a9a2da637b
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1f4a2be3d9'
+down_revision = '54a9a2da637b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Actor', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('Movie', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Movie', 'version')
+    op.drop_column('Actor', 'version')
@@ -0,0 +1,25 @@
+"""add job heartbeats
+
+Revision ID: 8f2c6a4d1b93
+Revises: 5d8b1f3e7a26
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2c6a4d1b93'
+down_revision = '5d8b1f3e7a26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'Job', sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('Job', 'heartbeat_at')
@@ -0,0 +1,40 @@
+"""add background job table
+
+Revision ID: 9b2e5d1c4a7f
+Revises: 7c1f4a2be3d9
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2e5d1c4a7f'
+down_revision = '7c1f4a2be3d9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'Job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('params', sa.Text(), nullable=False),
+        sa.Column('progress', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('submitted_by', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_Job_status'), 'Job', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Job_status'), table_name='Job')
+    op.drop_table('Job')
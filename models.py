@@ -1,33 +1,192 @@
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+import datetime
 import json
 import os
+import routing
+import tenants
+from rowcache import row_cache
+
+'''
+RoutingSession
+    sends the tenant data (Actor and Movie) of a tenant with a shard to
+    that shard (see tenants.py). Other reads made inside read_only views go
+    to a replica (see routing.py), everything else, and every flush, to the
+    primary.
+'''
+
+
+def holds_tenant_data(mapper):
+    # mapper may be a Mapper or a mapped class.
+    return getattr(getattr(mapper, 'class_', mapper), '__tenant_data__',
+                   False)
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None and holds_tenant_data(mapper):
+            engine = tenants.shard_engine()
+            if engine is not None:
+                return engine
+        if not self._flushing:
+            engine = routing.read_engine()
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def mark_session_wrote(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def pin_writer_to_primary(session):
+    if session.info.pop('wrote', False):
+        routing.note_write()
 
-database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_session_wrote(session):
+    session.info.pop('wrote', None)
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+    database_path defaults to the DATABASE_URL environment variable, read
+    when the app is set up rather than when this module is imported.
+    The schema is created with db.create_all() unless create_schema is
+    False (or DB_CREATE_ALL=false in the environment), in which case the
+    schema is left to the migrations and no connection is made at startup.
+    Engines for any configured read replicas and tenant shards are
+    registered on the app, and create_all also creates the tenant tables
+    in every shard.
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, create_schema=None):
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+    if create_schema is None:
+        create_schema = create_schema_enabled()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+    app.extensions['replicas'] = routing.ReplicaSet(
+        [create_engine(url, pool_pre_ping=True)
+         for url in routing.replica_urls(app)],
+        health_interval=float(os.environ.get('REPLICA_HEALTH_SECONDS', 5))
+        )
+    app.extensions['shards'] = tenants.ShardMap(
+        {tenant: create_engine(url, pool_pre_ping=True)
+         for tenant, url in tenants.shard_urls(app).items()},
+        claim=tenants.tenant_claim(app)
+        )
+    if create_schema:
+        db.create_all()
+        for engine in app.extensions['shards'].engines.values():
+            db.Model.metadata.create_all(engine, tables=tenant_tables())
+
+
+'''
+dispose_engines()
+    drops pooled connections inherited from a parent process. Called in each
+    gunicorn worker after fork so workers never share a database socket.
+'''
+
+
+def dispose_engines():
+    if db.app is not None:
+        db.get_engine(db.app).dispose()
+        db.app.extensions['replicas'].dispose()
+        db.app.extensions['shards'].dispose()
+
+
+def create_schema_enabled():
+    value = os.environ.get('DB_CREATE_ALL', 'true')
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+
+'''
+unit_of_work(batch_size)
+    groups the writes made inside the block into one transaction. insert(),
+    update() and delete() stop committing on their own, pending changes
+    are flushed every batch_size writes to bound memory, and the whole
+    block is committed once on exit. Any exception rolls the block back
+    and is re-raised. Nested blocks join the outermost one.
+
+        with unit_of_work():
+            for row in rows:
+                Actor(**row).insert()
+
+    New rows get their id when they are flushed, call db.session.flush()
+    first if an id is needed inside the block.
+'''
+
+
+@contextmanager
+def unit_of_work(batch_size=500):
+    session = db.session()
+    if 'unit_of_work' in session.info:
+        yield session
+        return
+    session.info['unit_of_work'] = {'batch_size': batch_size, 'pending': 0}
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop('unit_of_work', None)
+
+
+def save():
+    # Commit now, or leave it to the surrounding unit_of_work.
+    session = db.session()
+    work = session.info.get('unit_of_work')
+    if work is None:
+        session.commit()
+        return
+    work['pending'] += 1
+    if work['pending'] >= work['batch_size']:
+        session.flush()
+        work['pending'] = 0
+
+
+'''
+Tenant data
+    models with __tenant_data__ set belong to the tenant of the request
+    and live in its shard, see RoutingSession.
+'''
+
+
+def tenant_tables():
+    return [model.__table__ for model in db.Model.__subclasses__()
+            if holds_tenant_data(model)]
 
 
 class Actor(db.Model):
     __tablename__ = 'Actor'
+    __tenant_data__ = True
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String, nullable=False)
+    # Bumped on every update, identifies the row's cached JSON.
+    version = db.Column(db.Integer, nullable=False, server_default='1')
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -44,22 +203,29 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        save()
 
     def update(self):
-        db.session.commit()
+        self.version = Actor.version + 1
+        save()
+        row_cache.invalidate('Actor', self.id, tenants.current_shard())
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        save()
+        row_cache.invalidate('Actor', self.id, tenants.current_shard())
 
 
 class Movie(db.Model):
     __tablename__ = 'Movie'
+    __tenant_data__ = True
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.Date, nullable=False)
+    # Movie is partitioned on release_date on Postgres, see partitions.py.
+    release_date = db.Column(db.Date, nullable=False, index=True)
+    # Bumped on every update, identifies the row's cached JSON.
+    version = db.Column(db.Integer, nullable=False, server_default='1')
 
     def __init__(self, title, release_date):
         self.title = title
@@ -74,11 +240,68 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        save()
 
     def update(self):
-        db.session.commit()
+        self.version = Movie.version + 1
+        save()
+        row_cache.invalidate('Movie', self.id, tenants.current_shard())
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        save()
+        row_cache.invalidate('Movie', self.id, tenants.current_shard())
+
+
+'''
+Job
+    a background job (see jobs.py). params and result hold JSON text so the
+    table works the same on Postgres and SQLite.
+'''
+
+
+class Job(db.Model):
+    __tablename__ = 'Job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    # queued, running, cancelling, done, failed or cancelled
+    status = db.Column(db.String, nullable=False, index=True)
+    params = db.Column(db.Text, nullable=False)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.String)
+    submitted_by = db.Column(db.String, nullable=False)
+    # The tenant the job runs for, None for DATABASE_URL's own data.
+    tenant = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    # Refreshed by the worker running the job, see jobs.expire_stale.
+    heartbeat_at = db.Column(db.DateTime)
+
+    def __init__(self, kind, params, submitted_by, tenant=None):
+        self.kind = kind
+        self.status = 'queued'
+        self.params = json.dumps(params)
+        self.progress = 0
+        self.submitted_by = submitted_by
+        self.tenant = tenant
+        self.created_at = self.updated_at = datetime.datetime.utcnow()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() + 'Z',
+            'updated_at': self.updated_at.isoformat() + 'Z'
+        }
+
+    def insert(self):
+        db.session.add(self)
+        save()
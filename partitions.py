@@ -0,0 +1,153 @@
+from sqlalchemy import text
+import datetime
+import re
+
+'''
+Movie partitions
+
+    On Postgres the Movie table is range partitioned on release_date
+    (migration 3e6a9c2d8f41): Movie_old holds the releases before
+    FIRST_PARTITION_YEAR, Movie_y<year> each later year, and Movie_default
+    anything no other partition covers yet. Queries that filter on
+    release_date, such as GET /movies?released_from=...&released_to=...,
+    only scan the partitions that can match.
+
+    ensure_partitions() adds the partitions of coming years so new releases
+    do not pile up in Movie_default, and archive() moves the partitions of
+    old releases to a cold tablespace, or detaches them from Movie into the
+    archive schema. Both are run from manage.py:
+
+        python manage.py add_partitions --ahead 2
+        python manage.py archive --before 2000 --tablespace cold
+
+    Every function takes a connection, run them inside engine.begin() so
+    each change is applied all at once or not at all.
+'''
+
+FIRST_PARTITION_YEAR = 1990
+OLD_PARTITION = 'Movie_old'
+DEFAULT_PARTITION = 'Movie_default'
+ARCHIVE_SCHEMA = 'archive'
+
+
+def year_partition(year):
+    return 'Movie_y{}'.format(year)
+
+
+def partition_year(name):
+    # The year a Movie_y<year> partition holds, None for other partitions.
+    match = re.match(r'^Movie_y(\d{4})$', name)
+    return int(match.group(1)) if match else None
+
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote_identifier(name)
+
+
+def is_partitioned(connection):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text(
+        "SELECT relkind FROM pg_class "
+        "WHERE oid = to_regclass('public.\"Movie\"')")).scalar() == 'p'
+
+
+def partitions(connection):
+    # Names of the partitions attached to Movie.
+    rows = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'public.\"Movie\"'::regclass"))
+    return sorted(row[0] for row in rows)
+
+
+def archived_partitions(connection):
+    # Names of the partitions archive() detached into the archive schema.
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = :schema AND c.relkind IN ('r', 'p')"),
+        {'schema': ARCHIVE_SCHEMA})
+    return sorted(row[0] for row in rows)
+
+
+'''
+create_year_partition(connection, year)
+    adds the partition for year. Rows of that year already stored in
+    Movie_default are moved into it, Postgres refuses the new partition
+    otherwise.
+'''
+
+
+def create_year_partition(connection, year):
+    name = quote(connection, year_partition(year))
+    default = quote(connection, DEFAULT_PARTITION)
+    bounds = {
+        'start': datetime.date(year, 1, 1),
+        'end': datetime.date(year + 1, 1, 1)
+    }
+    connection.execute(
+        'ALTER TABLE "Movie" DETACH PARTITION {}'.format(default))
+    connection.execute(text(
+        'CREATE TABLE {} PARTITION OF "Movie" '
+        'FOR VALUES FROM (:start) TO (:end)'.format(name)), bounds)
+    connection.execute(text(
+        'WITH moved AS ('
+        'DELETE FROM {} WHERE release_date >= :start '
+        'AND release_date < :end RETURNING *) '
+        'INSERT INTO "Movie" SELECT * FROM moved'.format(default)), bounds)
+    connection.execute(
+        'ALTER TABLE "Movie" ATTACH PARTITION {} DEFAULT'.format(default))
+
+
+def ensure_partitions(connection, ahead=2):
+    # Creates the missing yearly partitions up to this year plus ahead,
+    # return the names of the partitions created. Years from before the
+    # newest attached one, and archived years, are left alone: archive()
+    # detaches old years, recreating them would undo the archive.
+    attached = partitions(connection)
+    existing = set(attached) | set(archived_partitions(connection))
+    years = [partition_year(name) for name in attached]
+    first_year = max((year for year in years if year is not None),
+                     default=FIRST_PARTITION_YEAR)
+    created = []
+    last_year = datetime.date.today().year + ahead
+    for year in range(first_year, last_year + 1):
+        if year_partition(year) not in existing:
+            create_year_partition(connection, year)
+            created.append(year_partition(year))
+    return created
+
+
+'''
+archive(connection, before_year, tablespace=None, detach=False)
+    archives the partitions holding releases before before_year.
+
+    tablespace moves them to that tablespace (created beforehand on cheaper
+    storage), they stay part of Movie and can still be queried. detach
+    takes them out of Movie into the archive schema, GET /movies no longer
+    returns their rows but they are kept as archive."Movie_y<year>".
+    return the names of the archived partitions
+'''
+
+
+def archive(connection, before_year, tablespace=None, detach=False):
+    archived = []
+    for name in partitions(connection):
+        year = partition_year(name)
+        if name != OLD_PARTITION and (year is None or year >= before_year):
+            continue
+        quoted = quote(connection, name)
+        if tablespace is not None:
+            connection.execute('ALTER TABLE {} SET TABLESPACE {}'.format(
+                quoted, quote(connection, tablespace)))
+        if detach:
+            schema = quote(connection, ARCHIVE_SCHEMA)
+            connection.execute(
+                'CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+            connection.execute(
+                'ALTER TABLE "Movie" DETACH PARTITION {}'.format(quoted))
+            connection.execute(
+                'ALTER TABLE {} SET SCHEMA {}'.format(quoted, schema))
+        archived.append(name)
+    return archived
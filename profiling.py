@@ -0,0 +1,238 @@
+from collections import Counter
+from flask import g, request
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Request profiling
+
+    Profiles single requests in production. A request is profiled when it
+    carries an X-Profile header equal to the PROFILE_TOKEN secret, or at
+    random for a PROFILE_SAMPLE_RATE fraction (0 to 1) of requests. With
+    neither set no hook is installed and requests run exactly as before.
+
+    The default PROFILE_MODE=sample has a background thread record the
+    profiled request's stack every PROFILE_INTERVAL_MS (default 5). The
+    stacks are written to PROFILE_DIR as folded stacks, one
+    "frame;frame;... count" line per stack, the input of flamegraph.pl or
+    speedscope. The root frame of each stack is the phase it was sampled
+    in, found from the modules on the stack: auth (token checks, with
+    the JSON decoding they do), query (SQLAlchemy and the driver),
+    serialize (JSON encoding), view (the app's own code) or other (Flask
+    and Werkzeug). A summary per phase is logged.
+
+    PROFILE_MODE=cprofile runs cProfile over the request instead and
+    writes its stats, to be read with pstats or snakeviz. cProfile is
+    exact but slows the profiled request down several times.
+'''
+
+# Phases in the order they are looked for, each with the top-level
+# modules that belong to it.
+PHASES = (
+    ('query', ('sqlalchemy', 'flask_sqlalchemy', 'psycopg2', 'sqlite3',
+               'queries')),
+    ('serialize', ('json', 'flask.json', 'simplejson', 'rowcache')),
+    ('auth', ('auth', 'jose', 'cryptography', 'Crypto', 'ecdsa', 'rsa')),
+    ('view', ('app', 'models', 'routing', 'coalesce', 'jobs',
+              'writequeue', 'partitions', 'tenants'))
+)
+
+
+def module_phase(module):
+    for phase, modules in PHASES:
+        for name in modules:
+            if module == name or module.startswith(name + '.'):
+                return phase
+    return None
+
+
+def phase_of(stack):
+    # stack lists "module:function" names, outermost first. The phase is
+    # that of the innermost frame that belongs to one, so a query run
+    # from a view counts as query. JSON work called from auth, such as
+    # decoding the token segments, counts as auth rather than serialize.
+    phases = [module_phase(name.split(':', 1)[0]) for name in reversed(stack)]
+    phases = [phase for phase in phases if phase is not None]
+    if not phases:
+        return 'other'
+    if phases[0] == 'serialize':
+        callers = [phase for phase in phases if phase != 'serialize']
+        if callers and callers[0] == 'auth':
+            return 'auth'
+    return phases[0]
+
+
+def frame_stack(frame):
+    names = []
+    while frame is not None:
+        names.append('{}:{}'.format(
+            frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class SampledProfile:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = Counter()
+
+    def sample(self, frame):
+        stack = frame_stack(frame)
+        self.stacks[';'.join([phase_of(stack)] + stack)] += 1
+
+    def phases(self):
+        phases = Counter()
+        for stack, count in self.stacks.items():
+            phases[stack.split(';', 1)[0]] += count
+        return phases
+
+    def folded(self):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+'''
+Sampler
+    one thread per worker process that samples every request being
+    profiled. It sleeps on an event while there are none.
+'''
+
+
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def start(self, profile):
+        with self._lock:
+            # Threads do not survive a fork, start one per worker.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='profile-sampler',
+                                 daemon=True).start()
+            self._profiles[profile.thread_id] = profile
+            self._wake.set()
+
+    def stop(self, profile):
+        with self._lock:
+            self._profiles.pop(profile.thread_id, None)
+            if not self._profiles:
+                self._wake.clear()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            frames = sys._current_frames()
+            # Sampling under the lock means a stopped profile is never
+            # written to while its output is saved.
+            with self._lock:
+                for profile in self._profiles.values():
+                    frame = frames.get(profile.thread_id)
+                    if frame is not None:
+                        profile.sample(frame)
+            del frames
+            time.sleep(self.interval)
+
+
+def output_path(directory, suffix):
+    # e.g. 1603100000123-4242-GET-actors.folded
+    label = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-')
+    return os.path.join(directory, '{}-{}-{}-{}{}'.format(
+        int(time.time() * 1000), os.getpid(), request.method,
+        label or 'root', suffix))
+
+
+class RequestProfiler:
+    def __init__(self, token=None, sample_rate=0.0, mode='sample',
+                 interval=0.005, directory=None):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), 'casting-profiles')
+        self.sampler = Sampler(interval)
+
+    def wanted(self):
+        header = request.headers.get('X-Profile')
+        if header is not None and self.token is not None:
+            return hmac.compare_digest(
+                header.encode('utf-8'), self.token.encode('utf-8'))
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start_request(self):
+        if not self.wanted():
+            return
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+        else:
+            profile = SampledProfile(threading.get_ident())
+            self.sampler.start(profile)
+        g.request_profile = profile
+
+    def end_request(self, error=None):
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return
+        if self.mode == 'cprofile':
+            profile.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            path = output_path(self.directory, '.prof')
+            profile.dump_stats(path)
+            logger.info('Profiled %s %s: %s', request.method,
+                        request.path, path)
+            return
+        self.sampler.stop(profile)
+        os.makedirs(self.directory, exist_ok=True)
+        path = output_path(self.directory, '.folded')
+        with open(path, 'w') as f:
+            f.write(profile.folded())
+        phases = profile.phases()
+        logger.info('Profiled %s %s, %d samples (%s): %s',
+                    request.method, request.path, sum(phases.values()),
+                    ', '.join('{} {}'.format(phase, count)
+                              for phase, count in phases.most_common()),
+                    path)
+
+
+'''
+install(app)
+    registers the profiler on the app when PROFILE_TOKEN or
+    PROFILE_SAMPLE_RATE is set. Call it before other before_request
+    handlers so they are profiled too.
+    return the RequestProfiler, or None when profiling is off
+'''
+
+
+def install(app):
+    def setting(name, default=None):
+        return app.config.get(name, os.environ.get(name, default))
+
+    token = setting('PROFILE_TOKEN')
+    sample_rate = float(setting('PROFILE_SAMPLE_RATE', 0))
+    if not token and sample_rate <= 0:
+        return None
+    profiler = RequestProfiler(
+        token=token or None,
+        sample_rate=sample_rate,
+        mode=setting('PROFILE_MODE', 'sample'),
+        interval=float(setting('PROFILE_INTERVAL_MS', 5)) / 1000,
+        directory=setting('PROFILE_DIR'))
+    app.before_request(profiler.start_request)
+    app.teardown_request(profiler.end_request)
+    app.extensions['profiler'] = profiler
+    return profiler
@@ -0,0 +1,173 @@
+from collections import namedtuple
+from sqlalchemy import bindparam, func
+from sqlalchemy.ext import baked
+from models import db, Actor, Movie
+
+'''
+Hot queries
+
+    The lookups every route makes are built once as baked queries, so
+    SQLAlchemy caches their compiled SQL and only binds new parameters on
+    each call instead of rebuilding and recompiling the query.
+'''
+
+bakery = baked.bakery()
+
+'''
+List rows
+
+    The list endpoints select plain column tuples instead of ORM instances,
+    so no identity map or instance state is built for rows that are only
+    serialized. ActorRow and MovieRow are slotted named tuples with the
+    same format() as their model, which is all rowcache needs. Rows are
+    fetched LIST_FETCH_SIZE at a time, so at most that many of SQLAlchemy's
+    own result rows exist at once.
+'''
+
+LIST_FETCH_SIZE = 1000
+
+
+class ActorRow(namedtuple('ActorRow', 'id name age gender version')):
+    __slots__ = ()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'age': self.age,
+            'gender': self.gender
+        }
+
+
+class MovieRow(namedtuple('MovieRow', 'id title release_date version')):
+    __slots__ = ()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'release_date': self.release_date.strftime('%Y-%m-%d')
+        }
+
+
+_actor_rows = bakery(lambda session: session.query(
+    Actor.id, Actor.name, Actor.age, Actor.gender, Actor.version))
+_actor_rows += lambda q: q.order_by(Actor.id).yield_per(LIST_FETCH_SIZE)
+
+_movie_rows = bakery(lambda session: session.query(
+    Movie.id, Movie.title, Movie.release_date, Movie.version))
+_movie_rows += lambda q: q.order_by(Movie.id).yield_per(LIST_FETCH_SIZE)
+
+# Both bounds are inclusive, the release_date filter lets Postgres skip the
+# partitions outside them.
+_movie_rows_released = bakery(lambda session: session.query(
+    Movie.id, Movie.title, Movie.release_date, Movie.version))
+_movie_rows_released += lambda q: q.filter(
+    Movie.release_date >= bindparam('released_from'),
+    Movie.release_date <= bindparam('released_to'))
+_movie_rows_released += lambda q: q.order_by(Movie.id).yield_per(
+    LIST_FETCH_SIZE)
+
+_all_actors = bakery(lambda session: session.query(Actor))
+_all_actors += lambda q: q.order_by(Actor.id)
+
+_actor_by_id = bakery(lambda session: session.query(Actor))
+_actor_by_id += lambda q: q.filter(Actor.id == bindparam('id'))
+
+_actors_by_ids = bakery(lambda session: session.query(Actor))
+_actors_by_ids += lambda q: q.filter(
+    Actor.id.in_(bindparam('ids', expanding=True)))
+
+_actor_name_taken = bakery(lambda session: session.query(Actor.id))
+_actor_name_taken += lambda q: q.filter(
+    func.upper(Actor.name) == func.upper(bindparam('name')))
+
+_actor_names_taken = bakery(
+    lambda session: session.query(func.upper(Actor.name)))
+_actor_names_taken += lambda q: q.filter(
+    func.upper(Actor.name).in_(bindparam('names', expanding=True)))
+
+_all_movies = bakery(lambda session: session.query(Movie))
+_all_movies += lambda q: q.order_by(Movie.id)
+
+_movie_by_id = bakery(lambda session: session.query(Movie))
+_movie_by_id += lambda q: q.filter(Movie.id == bindparam('id'))
+
+_movies_by_ids = bakery(lambda session: session.query(Movie))
+_movies_by_ids += lambda q: q.filter(
+    Movie.id.in_(bindparam('ids', expanding=True)))
+
+_movie_title_taken = bakery(lambda session: session.query(Movie.id))
+_movie_title_taken += lambda q: q.filter(
+    func.upper(Movie.title) == func.upper(bindparam('title')))
+
+_movie_titles_taken = bakery(
+    lambda session: session.query(func.upper(Movie.title)))
+_movie_titles_taken += lambda q: q.filter(
+    func.upper(Movie.title).in_(bindparam('titles', expanding=True)))
+
+
+def all_actors():
+    return _all_actors(db.session()).all()
+
+
+def actor_rows():
+    return [ActorRow._make(row) for row in _actor_rows(db.session())]
+
+
+def actor_by_id(actor_id):
+    return _actor_by_id(db.session()).params(id=actor_id).one_or_none()
+
+
+def actors_by_ids(ids):
+    return _actors_by_ids(db.session()).params(ids=list(ids)).all()
+
+
+def actor_name_taken(name):
+    return _actor_name_taken(db.session()).params(name=name).first() \
+        is not None
+
+
+def actor_names_taken(names):
+    # Returns the upper-cased names, out of names, that are already taken.
+    names = [name.upper() for name in names]
+    if not names:
+        return set()
+    return {row[0] for row in
+            _actor_names_taken(db.session()).params(names=names)}
+
+
+def all_movies():
+    return _all_movies(db.session()).all()
+
+
+def movie_rows():
+    return [MovieRow._make(row) for row in _movie_rows(db.session())]
+
+
+def movie_rows_released(released_from, released_to):
+    return [MovieRow._make(row) for row in _movie_rows_released(
+        db.session()).params(
+            released_from=released_from, released_to=released_to)]
+
+
+def movie_by_id(movie_id):
+    return _movie_by_id(db.session()).params(id=movie_id).one_or_none()
+
+
+def movies_by_ids(ids):
+    return _movies_by_ids(db.session()).params(ids=list(ids)).all()
+
+
+def movie_title_taken(title):
+    return _movie_title_taken(db.session()).params(title=title).first() \
+        is not None
+
+
+def movie_titles_taken(titles):
+    # Returns the upper-cased titles, out of titles, that are already taken.
+    titles = [title.upper() for title in titles]
+    if not titles:
+        return set()
+    return {row[0] for row in
+            _movie_titles_taken(db.session()).params(titles=titles)}
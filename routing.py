@@ -0,0 +1,148 @@
+from flask import current_app, g, has_request_context, request
+from functools import wraps
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Read replica routing
+
+    When replica URLs are configured (SQLALCHEMY_REPLICA_URIS in the app
+    config, or a comma separated DATABASE_REPLICA_URLS in the environment)
+    queries made by views decorated with read_only go to a replica picked
+    round-robin. Everything else, including every flush, goes to the
+    primary DATABASE_URL.
+
+    A client that has just written is pinned to the primary for
+    READ_AFTER_WRITE_SECONDS (default 5) so it always reads its own writes.
+    The pin travels with the client as a cookie holding the time it ends,
+    so whichever worker serves the client's next request honours it.
+'''
+
+
+class ReplicaSet:
+    def __init__(self, engines, health_interval=5.0):
+        self.engines = list(engines)
+        self.health_interval = health_interval
+        self._cycle = itertools.cycle(range(len(self.engines)))
+        self._lock = threading.Lock()
+        self._checked_at = {}
+        self._down = set()
+
+    def choose(self):
+        # Try every replica once, starting at the next one in the rotation,
+        # and return None when they are all down.
+        for _ in range(len(self.engines)):
+            with self._lock:
+                index = next(self._cycle)
+            if self.healthy(index):
+                return self.engines[index]
+        return None
+
+    def healthy(self, index):
+        # Replicas are pinged at most once every health_interval seconds,
+        # between pings the last result is reused.
+        now = time.time()
+        if now - self._checked_at.get(index, 0) < self.health_interval:
+            return index not in self._down
+        self._checked_at[index] = now
+        try:
+            with self.engines[index].connect() as connection:
+                connection.execute('SELECT 1')
+        except Exception:
+            if index not in self._down:
+                logger.warning('Read replica %d is unavailable.', index,
+                               exc_info=True)
+            self._down.add(index)
+            return False
+        self._down.discard(index)
+        return True
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def replica_urls(app):
+    urls = app.config.get('SQLALCHEMY_REPLICA_URIS')
+    if urls is None:
+        urls = os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    return [url.strip() for url in urls if url and url.strip()]
+
+
+'''
+Read-after-write pinning
+
+    A request that wrote gets a PIN_COOKIE cookie back from send_pin, set
+    as an after_request hook. A forged or altered cookie can only send its
+    own client's reads to the primary.
+'''
+
+PIN_COOKIE = 'db_primary_until'
+
+
+def read_after_write_seconds():
+    return float(os.environ.get('READ_AFTER_WRITE_SECONDS', 5))
+
+
+def note_write():
+    if not has_request_context():
+        return
+    g.db_primary_until = time.time() + read_after_write_seconds()
+
+
+def pinned_to_primary():
+    if g.get('db_primary_until') is not None:
+        return True
+    try:
+        until = float(request.cookies.get(PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def send_pin(response):
+    # Hands the pin of a request that wrote to its client.
+    until = g.pop('db_primary_until', None)
+    if until is not None:
+        response.set_cookie(
+            PIN_COOKIE, '{:.3f}'.format(until),
+            max_age=int(math.ceil(read_after_write_seconds())),
+            httponly=True, samesite='Lax')
+    return response
+
+
+'''
+read_only(f)
+    marks a view as safe to serve from a replica. Apply it below
+    requires_auth so the caller is known when the route is chosen.
+'''
+
+
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def read_engine():
+    # Returns the replica engine for this request, or None when the query
+    # belongs on the primary.
+    if not has_request_context() or not g.get('db_read_only'):
+        return None
+    replicas = current_app.extensions.get('replicas')
+    if replicas is None or not replicas.engines:
+        return None
+    if 'db_read_engine' not in g:
+        if pinned_to_primary():
+            g.db_read_engine = None
+        else:
+            g.db_read_engine = replicas.choose()
+    return g.db_read_engine
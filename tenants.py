@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context
+import os
+
+'''
+Tenant shards
+
+    Several agencies (tenants) share one deployment. A request's tenant is
+    the TENANT_CLAIM claim of its token, by default org_id, the claim Auth0
+    Organizations add. The shard map, TENANT_SHARDS in the app config (a
+    dict of tenant to URL) or a comma separated list of tenant=url in the
+    environment, gives a tenant a database of its own: the Actor and Movie
+    rows its requests, jobs and group commits read and write are kept
+    there, and each shard has its own connection pool.
+
+    A shard can also be a schema of a shared Postgres server, through a
+    URL that sets the search path, e.g.
+    postgresql://host/casting?options=-csearch_path%3Dacme
+
+    Tokens without the claim use DATABASE_URL as before. Once the map is
+    set, a token that names a tenant without a shard is refused with 403,
+    the rows of such tenants would otherwise be mixed together in
+    DATABASE_URL. With an empty map there is no sharding and every token
+    uses DATABASE_URL. Job rows always stay in DATABASE_URL, the one queue
+    every job worker polls, together with the tenant they run for. Read
+    replicas only serve DATABASE_URL.
+'''
+
+
+class ShardMap:
+    def __init__(self, engines, claim='org_id'):
+        # engines maps each tenant with a shard to its engine.
+        self.engines = dict(engines)
+        self.claim = claim
+
+    def tenant_of(self, payload):
+        tenant = payload.get(self.claim)
+        return tenant if isinstance(tenant, str) and tenant else None
+
+    def dispose(self):
+        for engine in self.engines.values():
+            engine.dispose()
+
+
+def shard_urls(app):
+    shards = app.config.get('TENANT_SHARDS')
+    if shards is None:
+        shards = {}
+        for entry in os.environ.get('TENANT_SHARDS', '').split(','):
+            tenant, _, url = entry.partition('=')
+            if tenant.strip() and url.strip():
+                shards[tenant.strip()] = url.strip()
+    return dict(shards)
+
+
+def tenant_claim(app):
+    return app.config.get(
+        'TENANT_CLAIM', os.environ.get('TENANT_CLAIM', 'org_id'))
+
+
+def token_refused(payload):
+    # True for a token naming a tenant that has no shard, while shards are
+    # configured. A claim that is not a tenant name is refused as well.
+    shards = current_app.extensions['shards']
+    if not shards.engines or shards.claim not in payload:
+        return False
+    return shards.tenant_of(payload) not in shards.engines
+
+
+def current_tenant():
+    # The tenant of the token being served, or the one set by using().
+    if not has_app_context():
+        return None
+    if 'tenant' in g:
+        return g.tenant
+    user = g.get('current_user')
+    if not user:
+        return None
+    return current_app.extensions['shards'].tenant_of(user)
+
+
+def current_shard():
+    # The tenant whose shard serves the current tenant's data, None when
+    # that is DATABASE_URL. Caches key their entries on it.
+    tenant = current_tenant()
+    if tenant is None:
+        return None
+    shards = current_app.extensions['shards']
+    return tenant if tenant in shards.engines else None
+
+
+def shard_engine():
+    shard = current_shard()
+    if shard is None:
+        return None
+    return current_app.extensions['shards'].engines[shard]
+
+
+'''
+using(tenant)
+    runs the block for tenant, for work done outside of the tenant's own
+    request such as background jobs and group commits. Call it inside an
+    app context and start the block with a fresh session, an identity map
+    must never mix the rows of two shards. Raise LookupError for a tenant
+    that has lost its shard, rather than use DATABASE_URL for its rows.
+'''
+
+
+@contextmanager
+def using(tenant):
+    shards = current_app.extensions['shards']
+    if tenant is not None and shards.engines and \
+            tenant not in shards.engines:
+        raise LookupError('Tenant {} has no shard.'.format(tenant))
+    had_tenant, previous = 'tenant' in g, g.get('tenant')
+    g.tenant = tenant
+    try:
+        yield
+    finally:
+        if had_tenant:
+            g.tenant = previous
+        else:
+            g.pop('tenant', None)
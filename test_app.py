@@ -1,9 +1,54 @@
+import base64
+import datetime
 import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
-from app import create_app
-from models import setup_db
+
+'''
+Test profiles
+
+    TEST_PROFILE=offline (the default) runs the suite against an in-memory
+    SQLite database (or TEST_DATABASE_URL) seeded with the casting.psql
+    rows, with tokens signed by a local key, so no network, Postgres or
+    Auth0 account is needed. TEST_PROFILE=live runs it against the
+    casting_test Postgres database with the Auth0 tokens from setup.sh.
+'''
+
+TEST_PROFILE = os.environ.get('TEST_PROFILE', 'offline')
+if TEST_PROFILE == 'offline':
+    # Importing app builds the module level app, give it a database that
+    # needs no server.
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ.setdefault('AUTH0_DOMAIN', 'casting.test')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('API_AUDIENCE', 'capstoneCastingAPI')
+    os.environ.setdefault('DB_CREATE_ALL', 'false')
+
+from flask import Flask, jsonify
+from app import create_app, parse_date
+import auth
+from models import db, Actor, Job, unit_of_work
+import jobs
+import partitions
+import queries
+from sqlalchemy import create_engine, event
+from health import DatabaseCheck, JwksCheck, RollingLatency, readiness
+from instrumentation import budget_violations, query_budget
+from profiling import phase_of
+from formats import MSGPACK, msgpack
+from routing import PIN_COOKIE, read_only
+from tenants import shard_urls
+from coalesce import SingleFlight
+from rowcache import RowCache, list_body, row_cache
+from writequeue import GroupCommitWriter, ValidationError, WriteUnavailable
+from testing import (LocalSigner, ROLE_PERMISSIONS, seed_casting_data,
+                     sqlite_config)
 
 '''
 CastingTestCase
@@ -17,18 +62,63 @@ dbp = "{}://{}:{}@{}/{}"
 
 
 class CapstoneCastingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # One app and one schema are shared by every test.
+        if TEST_PROFILE == 'live':
+            # The schema comes from casting.psql, so skip create_all.
+            cls.database_name = "casting_test"
+            cls.database_path = dbp.format(pg, p, p, l, cls.database_name)
+            cls.app = create_app({
+                'SQLALCHEMY_DATABASE_URI': cls.database_path,
+                'DB_CREATE_ALL': False,
+                'QUERY_INSTRUMENTATION': True
+            })
+            cls.tokens = {
+                'executive_producer': os.environ['EXECUTIVE_PRODUCER_TOKEN'],
+                'casting_director': os.environ['CASTING_DIRECTOR_TOKEN'],
+                'casting_assistant': os.environ['CASTING_ASSISTANT_TOKEN'],
+                'bad': os.environ['BAD_TOKEN']
+            }
+            return
+
+        # Query instrumentation lets tearDown enforce the routes' budgets.
+        cls.app = create_app(dict(
+            sqlite_config(os.environ.get('TEST_DATABASE_URL', 'sqlite://')),
+            QUERY_INSTRUMENTATION=True))
+        with cls.app.app_context():
+            seed_casting_data()
+        signer = LocalSigner()
+        cls.tokens = {
+            role: signer.token(permissions)
+            for role, permissions in ROLE_PERMISSIONS.items()
+        }
+        # A token issued for another API, as the live BAD_TOKEN is.
+        cls.tokens['bad'] = signer.token(
+            ['get:drinks', 'post:drinks'], audience='coffeeShopAPIID')
+        # A valid token that names no subject.
+        cls.tokens['no_sub'] = signer.token(
+            ROLE_PERMISSIONS['executive_producer'], sub=None)
+
     def setUp(self):
         # Define test variables and initialize app.
-        self.app = create_app()
+        # Each test runs inside a transaction that tearDown rolls back, the
+        # app's own commits only end a subtransaction of it.
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.connection = db.get_engine(self.app).connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
+        row_cache.clear()
+        self.violations = len(budget_violations(self.app))
         self.client = self.app.test_client
-        self.database_name = "casting_test"
-        self.database_path = dbp.format(pg, p, p, l, self.database_name)
-        setup_db(self.app, self.database_path)
 
-        executive_producer_token = os.environ['EXECUTIVE_PRODUCER_TOKEN']
-        casting_director_token = os.environ['CASTING_DIRECTOR_TOKEN']
-        casting_assistant_token = os.environ['CASTING_ASSISTANT_TOKEN']
-        bad_token = os.environ['BAD_TOKEN']
+        executive_producer_token = self.tokens['executive_producer']
+        casting_director_token = self.tokens['casting_director']
+        casting_assistant_token = self.tokens['casting_assistant']
+        bad_token = self.tokens['bad']
 
         self.executive_header = {
             "Authorization": "Bearer {}".format(executive_producer_token)
@@ -93,15 +183,16 @@ class CapstoneCastingTestCase(unittest.TestCase):
             "release_date": "September 10, 1994"
         }
 
-        # Binds the app to the current context.
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
-
     def tearDown(self):
         # Executed after reach test.
-        pass
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        self.ctx.pop()
+        # Fail a test whose requests ran more queries than their route's
+        # query_budget.
+        self.assertEqual(budget_violations(self.app)[self.violations:], [])
 
     def test_get_actors_by_executive_producer(self):
         # Test for successful retrieval of all actors.
@@ -193,6 +284,112 @@ class CapstoneCastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unauthorized')
 
+    def test_get_actor_by_id(self):
+        # Test for successful retrieval of a single actor.
+        res = self.client().get('/actors/1', headers=self.assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actor']['id'], 1)
+
+    def test_get_actor_by_id_404_fail(self):
+        # actor not found
+        res = self.client().get('/actors/500', headers=self.assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_get_actors_by_ids(self):
+        # Test for batched retrieval, in request order, with misses.
+        res = self.client().get(
+            '/actors?ids=3,1,500', headers=self.assistant_header
+            )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([actor['id'] for actor in data['actors']], [3, 1])
+        self.assertEqual(data['missing'], [500])
+
+    def test_get_actors_by_ids_400_fail(self):
+        # bad request, ids must be integers
+        res = self.client().get(
+            '/actors?ids=1,two', headers=self.assistant_header
+            )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_get_movie_by_id(self):
+        # Test for successful retrieval of a single movie.
+        res = self.client().get('/movies/1', headers=self.assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['movie']['id'], 1)
+
+    def test_get_movies_by_ids(self):
+        # Test for batched retrieval, in request order, with misses.
+        res = self.client().get(
+            '/movies?ids=2,500,1', headers=self.assistant_header
+            )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 1])
+        self.assertEqual(data['missing'], [500])
+
+    def test_get_movies_released_between(self):
+        # Test for filtering movies by release date, both bounds included.
+        res = self.client().get(
+            '/movies?released_from=2019-05-21&released_to=2019-08-31',
+            headers=self.assistant_header
+            )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [movie['title'] for movie in data['movies']],
+            ['Joker', 'Parasite', 'Once Upon a Time in Hollywood'])
+
+        res = self.client().get(
+            '/movies?released_from=2020-01-01', headers=self.assistant_header
+            )
+        data = json.loads(res.data)
+        self.assertEqual(
+            [movie['title'] for movie in data['movies']], ['1917'])
+
+    def test_get_movies_released_400_fail(self):
+        # bad request, the bound is not a date
+        res = self.client().get(
+            '/movies?released_to=someday', headers=self.assistant_header
+            )
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_post_movie_release_date_not_a_string_422_fail(self):
+        # unprocessable, the date is a number
+        res = self.client().post('/movies', headers=self.executive_header,
+                                 json={'title': 'Pan', 'release_date': 2015})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_movie_by_id_401_fail(self):
+        # unauthorized, permission not granted
+        res = self.client().get('/movies/1', headers=self.bad_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unauthorized')
+
     def test_post_new_actor_by_executive_producer(self):
         # Test for the successful creation of a new actor.
         res = self.client().post(
@@ -226,6 +423,18 @@ class CapstoneCastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_post_duplicate_actor_422_fail(self):
+        # bad request, an actor with that name (in any case) exists.
+        res = self.client().post(
+            '/actors', headers=self.executive_header,
+            json={"name": "leonardo dicaprio", "age": 45, "gender": "M"}
+            )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable')
+
     def test_post_new_actor_by_casting_assistant_401_fail(self):
         # unauthorized, permission not granted
         res = self.client().post(
@@ -506,6 +715,1197 @@ class CapstoneCastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unauthorized')
 
+    def test_create_job_by_executive_producer(self):
+        # Test that a job is queued and can be polled.
+        res = self.client().post('/jobs', json={
+            'kind': 'import_actors', 'params': {'actors': [self.new_actor]}
+            }, headers=self.executive_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+        self.assertTrue(res.headers['Location'].endswith(
+            '/jobs/{}'.format(data['job']['id'])))
+
+        res = self.client().get(
+            '/jobs/{}'.format(data['job']['id']),
+            headers=self.executive_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['job']['kind'], 'import_actors')
+
+    def test_create_job_by_casting_assistant_401_fail(self):
+        # unauthorized, an import needs the post permission
+        res = self.client().post('/jobs', json={
+            'kind': 'import_actors', 'params': {'actors': []}
+            }, headers=self.assistant_header)
+
+        self.assertEqual(res.status_code, 401)
+
+    @unittest.skipIf(TEST_PROFILE == 'live', 'needs a locally signed token')
+    def test_create_job_without_sub_401_fail(self):
+        res = self.client().post('/jobs', json={'kind': 'stats'}, headers={
+            'Authorization': 'Bearer ' + self.tokens['no_sub']})
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_create_job_unknown_kind_422_fail(self):
+        res = self.client().post(
+            '/jobs', json={'kind': 'reindex'}, headers=self.executive_header)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_cancel_queued_job(self):
+        res = self.client().post(
+            '/jobs', json={'kind': 'stats'}, headers=self.assistant_header)
+        path = '/jobs/{}'.format(json.loads(res.data)['job']['id'])
+
+        res = self.client().delete(path, headers=self.assistant_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['job']['status'], 'cancelled')
+
+        # A finished job can not be cancelled again.
+        res = self.client().delete(path, headers=self.assistant_header)
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_job_404_fail(self):
+        res = self.client().get('/jobs/500', headers=self.executive_header)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_responses_vary_on_accept(self):
+        # Shared caches must not serve one format to clients of the other,
+        # whether the body is a coalesced list, a single row or an error.
+        for path, headers in (('/actors', self.assistant_header),
+                              ('/actors/1', self.assistant_header),
+                              ('/actors/500', self.assistant_header),
+                              ('/actors', {})):
+            res = self.client().get(path, headers=headers)
+            self.assertIn('Accept', res.vary, path)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_get_actors_as_msgpack(self):
+        # Test that the msgpack list body holds the same data as the JSON.
+        headers = dict(self.assistant_header, Accept=MSGPACK)
+        res = self.client().get('/actors', headers=headers)
+        json_res = self.client().get('/actors', headers=self.assistant_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, MSGPACK)
+        self.assertEqual(msgpack.unpackb(res.data, raw=False),
+                         json.loads(json_res.data))
+        self.assertEqual(json_res.mimetype, 'application/json')
+        self.assertIn('Accept', res.vary)
+        self.assertIn('Accept', json_res.vary)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_post_actor_as_msgpack(self):
+        headers = dict(self.executive_header, Accept=MSGPACK)
+        res = self.client().post(
+            '/actors', headers=headers, content_type=MSGPACK,
+            data=msgpack.packb(self.new_actor, use_bin_type=True))
+        data = msgpack.unpackb(res.data, raw=False)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], self.new_actor['name'])
+
+        # Errors are answered in msgpack too.
+        res = self.client().get('/actors/500', headers=headers)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(msgpack.unpackb(res.data, raw=False)['error'], 404)
+        self.assertIn('Accept', res.vary)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_post_actor_bad_msgpack_400_fail(self):
+        res = self.client().post(
+            '/actors', headers=self.executive_header, content_type=MSGPACK,
+            data=b'\xc1')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_list_rows_skip_the_orm(self):
+        # List rows are plain tuples formatted the same as the models.
+        rows = queries.actor_rows()
+
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertIsInstance(rows[0], queries.ActorRow)
+        self.assertEqual([row.format() for row in rows],
+                         [actor.format() for actor in queries.all_actors()])
+        self.assertEqual(
+            [row.format() for row in queries.movie_rows()],
+            [movie.format() for movie in queries.all_movies()])
+
+    def test_healthz_needs_no_token(self):
+        res = self.client().get('/healthz')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['status'], 'ok')
+
+    def test_readyz(self):
+        res = self.client().get('/readyz')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['database']['ok'], True)
+        self.assertGreaterEqual(data['database']['latency']['count'], 1)
+        self.assertEqual(data['jwks']['loaded'], True)
+
+    def test_query_count_header(self):
+        res = self.client().get('/actors/1', headers=self.assistant_header)
+
+        self.assertEqual(res.headers['X-Query-Count'], '1')
+
+
+'''
+ParseDateTestCase
+    Checks the ISO fast path, the dateutil fallback and bad input.
+'''
+
+
+class ParseDateTestCase(unittest.TestCase):
+    def test_iso_date(self):
+        self.assertEqual(parse_date('2019-08-31'), datetime.date(2019, 8, 31))
+
+    def test_other_formats(self):
+        expected = datetime.date(2015, 9, 20)
+        for text in ('September 20, 2015', '20 Sep 2015', '09/20/2015',
+                     'released on September 20, 2015'):
+            self.assertEqual(parse_date(text), expected, text)
+
+    def test_invalid_input(self):
+        for value in ('someday', '', '2019-02-30', '9' * 20, None, 2015,
+                      ['2019-08-31']):
+            self.assertIsNone(parse_date(value), value)
+
+    def test_partial_dates_are_not_completed(self):
+        # Fuzzy parsing must not make up the fields a string leaves out.
+        for text in ('room 12', 'September 2015', 'September 20',
+                     'in 2015', 'Tuesday'):
+            self.assertIsNone(parse_date(text), text)
+
+
+'''
+MalformedTokenTestCase
+    Checks that forged tokens with claims of the wrong type get 401, not
+    a server error, before their signature is ever checked.
+'''
+
+
+class MalformedTokenTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(sqlite_config())
+        cls.signer = LocalSigner()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.get_engine(cls.app).dispose()
+
+    def forged_status(self, header=None, **claims):
+        def segment(data):
+            return base64.urlsafe_b64encode(
+                json.dumps(data).encode('utf-8')).rstrip(b'=').decode()
+        config = auth.auth_config()
+        payload = {
+            'iss': 'https://' + config['AUTH0_DOMAIN'] + '/',
+            'sub': 'local|forger',
+            'aud': config['API_AUDIENCE'],
+            'exp': int(time.time()) + 3600,
+            'permissions': ['get:actors']
+        }
+        payload.update(claims)
+        token = '.'.join([
+            segment(dict({'alg': 'RS256', 'kid': self.signer.kid},
+                         **(header or {}))),
+            segment(payload), 'c2lnbmF0dXJl'])
+        res = self.app.test_client().get(
+            '/actors', headers={'Authorization': 'Bearer ' + token})
+        return res.status_code
+
+    def test_non_numeric_exp(self):
+        self.assertEqual(self.forged_status(exp='soon'), 401)
+
+    def test_non_numeric_nbf(self):
+        self.assertEqual(self.forged_status(nbf='x'), 401)
+
+    def test_boolean_exp(self):
+        self.assertEqual(self.forged_status(exp=True), 401)
+
+    def test_numeric_aud(self):
+        self.assertEqual(self.forged_status(aud=5), 401)
+
+    def test_aud_list_with_non_string(self):
+        self.assertEqual(self.forged_status(aud=[5, {}]), 401)
+
+    def test_list_kid(self):
+        self.assertEqual(self.forged_status(header={'kid': ['a']}), 401)
+
+    def test_missing_kid(self):
+        self.assertEqual(self.forged_status(header={'kid': None}), 401)
+
+    def test_well_formed_forgery_fails_the_signature_check(self):
+        self.assertEqual(self.forged_status(), 400)
+
+
+'''
+HealthTestCase
+    Checks the cached database ping and the latency summaries.
+'''
+
+
+class HealthTestCase(unittest.TestCase):
+    def test_ping_is_cached_for_the_interval(self):
+        engine = create_engine('sqlite://')
+        pings = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda *args: pings.append(args[2]))
+        check = DatabaseCheck(engine, interval=60)
+
+        self.assertTrue(check.status()['ok'])
+        self.assertTrue(check.status()['ok'])
+        self.assertEqual(pings, ['SELECT 1'])
+
+        check.interval = 0
+        check.status()
+        self.assertEqual(len(pings), 2)
+
+    def test_unreachable_database_is_not_ready(self):
+        engine = create_engine('sqlite:////nonexistent/casting.db')
+        ready, checks = readiness(DatabaseCheck(engine), JwksCheck())
+
+        self.assertFalse(ready)
+        self.assertEqual(checks['database']['ok'], False)
+        self.assertEqual(checks['database']['error'], 'OperationalError')
+
+    def forget_jwks(self):
+        # As in a worker whose warm_up failed, put back after the test.
+        saved = dict(auth._jwks_cache)
+
+        def restore():
+            auth._jwks_cache.clear()
+            auth._jwks_cache.update(saved)
+        self.addCleanup(restore)
+        auth._jwks_cache.update({'jwks': None, 'fetched_at': 0.0})
+
+    def test_readyz_fetches_a_missing_jwks(self):
+        jwks = LocalSigner().jwks
+        self.forget_jwks()
+        with mock.patch.dict(os.environ, {'READY_JWKS_RETRY_SECONDS': '0'}):
+            app = create_app(sqlite_config())
+        self.addCleanup(db.get_engine(app).dispose)
+        outage = mock.patch.object(
+            auth, 'fetch_jwks', side_effect=[OSError('Auth0 is down'), jwks])
+        with outage:
+            res = app.test_client().get('/readyz')
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(json.loads(res.data)['jwks']['error'],
+                             'OSError')
+
+            res = app.test_client().get('/readyz')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['jwks']['loaded'], True)
+
+    def test_jwks_retries_are_spaced(self):
+        self.forget_jwks()
+        check = JwksCheck(interval=60)
+        with mock.patch.object(auth, 'fetch_jwks',
+                               side_effect=OSError) as fetch:
+            self.assertFalse(check.status()['loaded'])
+            self.assertFalse(check.status()['loaded'])
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_rolling_latency_keeps_the_last_samples(self):
+        latency = RollingLatency(size=10)
+        self.assertEqual(latency.summary()['count'], 0)
+        for ms in range(1, 21):
+            latency.record(ms / 1000)
+
+        self.assertEqual(latency.summary(), {
+            'count': 10, 'p50_ms': 16.0, 'p95_ms': 20.0, 'max_ms': 20.0})
+
+
+'''
+InstrumentationTestCase
+    Checks query budgets and the slow query log on an app of its own.
+'''
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def create_app(self, **config):
+        app = create_app(dict(sqlite_config(), **config))
+        with app.app_context():
+            seed_casting_data()
+
+        @app.route('/two-queries')
+        @query_budget(1)
+        def two_queries():
+            Actor.query.all()
+            Actor.query.all()
+            return jsonify({'success': True})
+        return app
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_route_over_budget_is_recorded(self):
+        app = self.create_app(QUERY_INSTRUMENTATION=True)
+        with self.assertLogs('instrumentation', 'WARNING'):
+            res = app.test_client().get('/two-queries')
+
+        self.assertEqual(res.headers['X-Query-Count'], '2')
+        self.assertEqual(budget_violations(app),
+                         [('GET', '/two-queries?', 2, 1)])
+
+    def test_slow_query_is_logged_with_its_plan(self):
+        app = self.create_app(SLOW_QUERY_MS=0)
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            app.test_client().get('/two-queries')
+
+        slow = [line for line in logs.output if 'Slow query' in line]
+        self.assertEqual(len(slow), 2)
+        self.assertIn('FROM "Actor"', slow[0])
+        self.assertIn('SCAN', slow[0])
+
+    def test_off_by_default(self):
+        app = self.create_app()
+        res = app.test_client().get('/two-queries')
+
+        self.assertNotIn('X-Query-Count', res.headers)
+        self.assertNotIn('query_stats', app.extensions)
+
+
+'''
+ProfilingTestCase
+    Checks that requests are profiled only when asked to.
+'''
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        shutil.rmtree(self.tmp)
+
+    def create_app(self, **config):
+        app = create_app(dict(sqlite_config(), PROFILE_DIR=self.tmp,
+                              PROFILE_INTERVAL_MS=1, **config))
+
+        @app.route('/slow')
+        def slow():
+            time.sleep(0.05)
+            return jsonify({'success': True})
+        return app
+
+    def profiles(self):
+        return sorted(os.listdir(self.tmp))
+
+    def test_privileged_header_writes_folded_stacks(self):
+        app = self.create_app(PROFILE_TOKEN='secret')
+        app.test_client().get('/slow', headers={'X-Profile': 'wrong'})
+        self.assertEqual(self.profiles(), [])
+
+        app.test_client().get('/slow', headers={'X-Profile': 'secret'})
+        files = self.profiles()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith('-GET-slow.folded'))
+        with open(os.path.join(self.tmp, files[0])) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertIn(stack.split(';')[0],
+                          ('auth', 'query', 'serialize', 'view', 'other'))
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('test_app:slow' in line for line in lines))
+
+    def test_cprofile_mode_writes_stats(self):
+        app = self.create_app(PROFILE_SAMPLE_RATE=1, PROFILE_MODE='cprofile')
+        app.test_client().get('/slow')
+
+        files = self.profiles()
+        self.assertEqual(len(files), 1)
+        stats = pstats.Stats(os.path.join(self.tmp, files[0]))
+        self.assertTrue(any(name == 'slow' for _, _, name in stats.stats))
+
+    def test_off_by_default(self):
+        app = self.create_app()
+        app.test_client().get('/slow', headers={'X-Profile': 'secret'})
+
+        self.assertEqual(self.profiles(), [])
+        self.assertNotIn('profiler', app.extensions)
+
+    def test_phase_of_innermost_known_module(self):
+        self.assertEqual(phase_of(
+            ['flask.app:dispatch', 'app:get_all_actors',
+             'queries:all_actors', 'sqlalchemy.orm.query:all']), 'query')
+        self.assertEqual(phase_of(
+            ['flask.app:dispatch', 'auth:wrapper', 'jose.jws:verify']),
+            'auth')
+        self.assertEqual(phase_of(
+            ['flask.app:dispatch', 'rowcache:list_body',
+             'json.encoder:encode']), 'serialize')
+        # JSON decoded by the token check is auth time, while a view's own
+        # encoding stays serialize though requires_auth is further out.
+        self.assertEqual(phase_of(
+            ['flask.app:dispatch', 'auth:wrapper', 'auth:verify_decode_jwt',
+             'jose.jwt:decode', 'json:loads', 'json.decoder:decode']),
+            'auth')
+        self.assertEqual(phase_of(
+            ['flask.app:dispatch', 'auth:wrapper', 'app:get_all_actors',
+             'rowcache:list_body', 'json.encoder:encode']), 'serialize')
+        self.assertEqual(phase_of(['werkzeug.serving:run']), 'other')
+
+
+'''
+ReplicaRoutingTestCase
+    Checks read replica routing against two SQLite databases, a primary
+    and a replica holding different rows.
+'''
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.primary_path = 'sqlite:///' + os.path.join(self.tmp, 'p.db')
+        self.replica_path = 'sqlite:///' + os.path.join(self.tmp, 'r.db')
+        # Build the replica first so it gets its own schema and row.
+        for path, name in ((self.replica_path, 'Replica Actor'),
+                           (self.primary_path, 'Primary Actor')):
+            self.app = create_app({
+                'SQLALCHEMY_DATABASE_URI': path,
+                'SQLALCHEMY_REPLICA_URIS': [self.replica_path],
+                'DB_CREATE_ALL': True
+            })
+            with self.app.app_context():
+                Actor(name=name, age=40, gender='F').insert()
+
+    def tearDown(self):
+        db.app.extensions['replicas'].dispose()
+        db.get_engine(db.app).dispose()
+        shutil.rmtree(self.tmp)
+
+    def read_first_name(self, pin=None):
+        headers = {}
+        if pin is not None:
+            headers['Cookie'] = '{}={}'.format(PIN_COOKIE, pin)
+        with self.app.test_request_context(headers=headers):
+            name = read_only(lambda: Actor.query.first().name)()
+            db.session.remove()
+            return name
+
+    def test_read_only_view_reads_from_replica(self):
+        self.assertEqual(self.read_first_name(), 'Replica Actor')
+
+    def test_other_queries_read_from_primary(self):
+        with self.app.test_request_context():
+            self.assertEqual(Actor.query.first().name, 'Primary Actor')
+
+    def test_client_reads_primary_after_own_write(self):
+        with self.app.test_request_context():
+            Actor(name='New Actor', age=30, gender='M').insert()
+            db.session.remove()
+            response = self.app.process_response(self.app.response_class())
+        cookie = response.headers['Set-Cookie']
+        self.assertTrue(cookie.startswith(PIN_COOKIE + '='))
+        pin = cookie.split(';')[0].split('=', 1)[1]
+
+        # The pin is read from the cookie, so any worker honours it.
+        self.assertEqual(self.read_first_name(pin), 'Primary Actor')
+        self.assertEqual(self.read_first_name(), 'Replica Actor')
+        self.assertEqual(self.read_first_name(time.time() - 1),
+                         'Replica Actor')
+        self.assertEqual(self.read_first_name('soon'), 'Replica Actor')
+
+    def test_reads_without_writes_set_no_pin(self):
+        with self.app.test_request_context():
+            read_only(lambda: Actor.query.first())()
+            response = self.app.process_response(self.app.response_class())
+            db.session.remove()
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        missing = 'sqlite:///' + os.path.join(self.tmp, 'missing', 'x.db')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.primary_path,
+            'SQLALCHEMY_REPLICA_URIS': [missing],
+            'DB_CREATE_ALL': False
+        })
+        self.assertEqual(self.read_first_name(), 'Primary Actor')
+
+
+'''
+SingleFlightTestCase
+    Checks that concurrent calls for one key share a single execution.
+'''
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def run_concurrently(self, flight, fn, callers=10):
+        results, errors = [], []
+        barrier = threading.Barrier(callers)
+
+        def call():
+            barrier.wait()
+            try:
+                results.append(flight.do('actors', fn))
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_run_once(self):
+        calls = []
+
+        def slow_query():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'body'
+
+        flight = SingleFlight()
+        results, errors = self.run_concurrently(flight, slow_query)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'body'] * 10)
+        # Nothing is cached once the call has finished.
+        self.assertEqual(flight.do('actors', lambda: b'fresh'), b'fresh')
+
+    def test_errors_reach_every_caller(self):
+        def failing_query():
+            time.sleep(0.2)
+            raise ValueError('database is down')
+
+        results, errors = self.run_concurrently(SingleFlight(), failing_query)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 10)
+
+
+'''
+RowCacheTestCase
+    Checks the cached JSON fragments against jsonify and row versions.
+'''
+
+
+class RowCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'DB_CREATE_ALL': False
+        })
+        # Other tests leave fragments of their own rows behind.
+        row_cache.clear()
+
+    def actor(self, actor_id, name, version=1):
+        actor = Actor(name=name, age=40, gender='F')
+        actor.id = actor_id
+        actor.version = version
+        return actor
+
+    def test_list_body_matches_jsonify(self):
+        actors = [self.actor(1, 'Cameron Diaz'), self.actor(2, 'Zoë')]
+        with self.app.test_request_context():
+            expected = jsonify({
+                'success': True,
+                'actors': [actor.format() for actor in actors]
+            }).get_data()
+        self.assertEqual(list_body('actors', 'Actor', actors), expected)
+
+    def test_new_version_replaces_fragment(self):
+        cache = RowCache(max_rows=10)
+        cache.fragment('Actor', self.actor(1, 'Old Name'))
+        fragment = cache.fragment('Actor', self.actor(1, 'New Name', 2))
+        self.assertIn(b'New Name', fragment)
+
+    def test_oldest_rows_are_evicted(self):
+        cache = RowCache(max_rows=2)
+        for actor_id in (1, 2, 3):
+            cache.fragment('Actor', self.actor(actor_id, 'Name'))
+        self.assertEqual(list(cache._rows), [
+            (None, 'Actor', 2, 'json'), (None, 'Actor', 3, 'json')])
+
+
+'''
+SQLiteFileTestCase
+    Base for tests that need an app on a fresh SQLite file.
+'''
+
+
+class SQLiteFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + os.path.join(self.tmp, 'casting.db'),
+            'SQLALCHEMY_REPLICA_URIS': [],
+            'DB_CREATE_ALL': True
+        })
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        db.get_engine(self.app).dispose()
+        shutil.rmtree(self.tmp)
+
+    def committed_names(self):
+        # Read through a separate connection to see only committed rows.
+        with db.get_engine(self.app).connect() as connection:
+            return [row[0] for row in
+                    connection.execute('SELECT name FROM "Actor"')]
+
+
+'''
+UnitOfWorkTestCase
+    Checks that writes inside unit_of_work commit once, or not at all.
+'''
+
+
+class UnitOfWorkTestCase(SQLiteFileTestCase):
+    def test_writes_commit_once_at_the_end(self):
+        with unit_of_work(batch_size=2):
+            for name in ('Actor A', 'Actor B', 'Actor C'):
+                Actor(name=name, age=30, gender='F').insert()
+            self.assertEqual(self.committed_names(), [])
+        self.assertEqual(sorted(self.committed_names()),
+                         ['Actor A', 'Actor B', 'Actor C'])
+
+    def test_error_rolls_back_every_write(self):
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                Actor(name='Actor A', age=30, gender='F').insert()
+                raise RuntimeError('seeding failed')
+        self.assertEqual(self.committed_names(), [])
+
+    def test_writes_outside_commit_immediately(self):
+        Actor(name='Actor A', age=30, gender='F').insert()
+        self.assertEqual(self.committed_names(), ['Actor A'])
+
+
+'''
+GroupCommitTestCase
+    Checks that concurrent inserts share commits but keep their own results.
+'''
+
+
+class GroupCommitTestCase(SQLiteFileTestCase):
+    def submit_concurrently(self, writer, names):
+        results = {}
+        barrier = threading.Barrier(len(names))
+
+        def submit(name):
+            barrier.wait()
+            try:
+                results[name] = writer.submit(
+                    lambda: Actor(name=name, age=30, gender='F'),
+                    unique=name.upper(),
+                    taken=lambda: False)
+            except ValidationError as error:
+                results[name] = error
+
+        threads = [threading.Thread(target=submit, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_inserts_get_their_own_ids(self):
+        writer = GroupCommitWriter(self.app, max_delay=0.05)
+        names = ['Actor {}'.format(i) for i in range(10)]
+        results = self.submit_concurrently(writer, names)
+
+        self.assertEqual({name: results[name]['name'] for name in names},
+                         {name: name for name in names})
+        self.assertEqual(len({result['id'] for result in results.values()}),
+                         10)
+        self.assertEqual(len(self.committed_names()), 10)
+
+    def test_duplicate_in_batch_is_rejected(self):
+        writer = GroupCommitWriter(self.app, max_delay=0.05)
+        results = self.submit_concurrently(writer, ['Jude Law', 'JUDE LAW'])
+
+        errors = [result for result in results.values()
+                  if isinstance(result, ValidationError)]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(self.committed_names()), 1)
+
+    def test_timed_out_insert_is_never_written(self):
+        writer = GroupCommitWriter(self.app, max_delay=0.3)
+        with self.assertRaises(WriteUnavailable):
+            writer.submit(lambda: Actor(name='Late', age=30, gender='F'),
+                          timeout=0.05)
+        time.sleep(0.5)
+
+        self.assertEqual(self.committed_names(), [])
+
+    def test_failed_batch_raises_write_unavailable(self):
+        writer = GroupCommitWriter(self.app, max_delay=0.01)
+
+        def taken():
+            raise RuntimeError('database went away')
+
+        with self.assertRaises(WriteUnavailable):
+            writer.submit(lambda: Actor(name='Lost', age=30, gender='F'),
+                          unique='LOST', taken=taken)
+
+
+'''
+CoalescedReadTestCase
+    Checks which list reads may share a single query and response body.
+'''
+
+
+class CoalescedReadTestCase(SQLiteFileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.signer = LocalSigner()
+        Actor(name='Old Actor', age=40, gender='F').insert()
+
+    def get_names(self, cookie=None):
+        headers = self.signer.headers(ROLE_PERMISSIONS['casting_assistant'])
+        if cookie is not None:
+            headers['Cookie'] = cookie
+        # Without its cookie jar the client sends the Cookie header as is.
+        client = self.app.test_client(use_cookies=False)
+        res = client.get('/actors', headers=headers)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_pinned_read_never_joins_a_flight_in_progress(self):
+        # The first read has queried its rows and is still building its
+        # body when the client writes and reads again.
+        started, release = threading.Event(), threading.Event()
+        actor_rows = queries.actor_rows
+
+        def slow_actor_rows():
+            rows = actor_rows()
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+            return rows
+
+        results = {}
+        with mock.patch.object(queries, 'actor_rows', slow_actor_rows):
+            first = threading.Thread(
+                target=lambda: results.update(first=self.get_names()))
+            first.start()
+            started.wait(5)
+            Actor(name='New Actor', age=30, gender='M').insert()
+            pin = '{}={}'.format(PIN_COOKIE, time.time() + 5)
+            pinned = threading.Thread(
+                target=lambda: results.update(pinned=self.get_names(pin)))
+            pinned.start()
+            pinned.join(2)
+            finished_alone = not pinned.is_alive()
+            release.set()
+            first.join()
+            pinned.join()
+
+        self.assertTrue(finished_alone)
+        self.assertEqual(results['first'], ['Old Actor'])
+        self.assertEqual(sorted(results['pinned']),
+                         ['New Actor', 'Old Actor'])
+
+
+'''
+JobsTestCase
+    Runs background jobs the way a worker process does.
+'''
+
+
+class JobsTestCase(SQLiteFileTestCase):
+    def submit(self, kind, params=None):
+        return jobs.submit(kind, params or {}, 'local|test-user')
+
+    def test_import_skips_invalid_and_duplicate_rows(self):
+        Actor(name='Jude Law', age=47, gender='M').insert()
+        job = self.submit('import_actors', {'actors': [
+            {'name': 'Actor A', 'age': 30, 'gender': 'f'},
+            {'name': 'JUDE LAW', 'age': 47, 'gender': 'M'},
+            {'name': 'Actor B', 'age': 30, 'gender': 'X'},
+            {'name': 'actor a', 'age': 31, 'gender': 'F'},
+            {'name': 'Actor C', 'age': 32, 'gender': 'M'}
+        ]})
+        jobs.run_next()
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((job.progress, job.total), (5, 5))
+        self.assertEqual(job.format()['result'],
+                         {'imported': 2, 'skipped': [1, 2, 3]})
+        self.assertEqual(sorted(self.committed_names()),
+                         ['Actor A', 'Actor C', 'Jude Law'])
+
+    def test_cancelled_job_stops_at_next_progress_report(self):
+        job = self.submit('import_actors', {'actors': [
+            {'name': 'Actor A', 'age': 30, 'gender': 'F'}
+        ]})
+        claimed = jobs.claim_next()
+        self.assertEqual(claimed.id, job.id)
+        self.assertTrue(jobs.cancel(job))
+        jobs.run(claimed)
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'cancelled')
+        self.assertEqual(self.committed_names(), [])
+        self.assertFalse(jobs.cancel(job))
+
+    def test_unknown_kind_fails(self):
+        job = self.submit('reindex')
+        jobs.run_next()
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'failed')
+        self.assertIsNone(jobs.run_next())
+
+    def age(self, job, seconds):
+        # Backdates the job's heartbeat as if its worker died seconds ago.
+        Job.query.filter(Job.id == job.id).update({
+            'heartbeat_at': jobs.utcnow() - datetime.timedelta(
+                seconds=seconds)})
+        db.session.commit()
+
+    def test_stale_running_job_is_failed(self):
+        job = self.submit('stats')
+        claimed = jobs.claim_next()
+        self.age(claimed, jobs.JOB_LEASE_SECONDS + 1)
+
+        self.assertIsNone(jobs.claim_next())
+        db.session.refresh(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'The job worker stopped.')
+
+    def test_stale_cancelling_job_is_cancelled(self):
+        job = self.submit('stats')
+        claimed = jobs.claim_next()
+        jobs.cancel(job)
+        self.age(claimed, jobs.JOB_LEASE_SECONDS + 1)
+
+        jobs.claim_next()
+        db.session.refresh(job)
+        self.assertEqual(job.status, 'cancelled')
+
+    def test_job_with_live_heartbeat_keeps_running(self):
+        job = self.submit('stats')
+        claimed = jobs.claim_next()
+        self.age(claimed, jobs.JOB_LEASE_SECONDS - 10)
+
+        jobs.claim_next()
+        db.session.refresh(job)
+        self.assertEqual(job.status, 'running')
+
+    def test_heartbeat_refreshes_the_lease(self):
+        job = self.submit('stats')
+        claimed = jobs.claim_next()
+        self.age(claimed, jobs.JOB_LEASE_SECONDS + 1)
+        with jobs.Heartbeat(db.get_engine(), job.id, interval=0.01):
+            time.sleep(0.1)
+        db.session.refresh(job)
+
+        self.assertGreater(job.heartbeat_at, jobs.utcnow() -
+                           datetime.timedelta(seconds=5))
+
+    def test_worker_runs_queued_jobs(self):
+        Actor(name='Actor A', age=30, gender='F').insert()
+        job_id = self.submit('stats').id
+        db.session.remove()
+        stop = threading.Event()
+        worker = threading.Thread(
+            target=jobs.work, args=(self.app, stop, 0.01))
+        worker.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                job = Job.query.get(job_id)
+                if job.status in jobs.FINISHED:
+                    break
+                db.session.remove()
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            worker.join()
+
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.format()['result']['actors'], 1)
+        self.assertEqual(job.format()['result']['genders'], {'F': 1})
+
+
+'''
+TenantShardTestCase
+    Runs the app with two tenants sharded to SQLite databases of their own,
+    next to the primary database used by tokens without a tenant.
+'''
+
+
+class TenantShardTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.signer = LocalSigner()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.urls = {
+            name: 'sqlite:///' + os.path.join(self.tmp, name + '.db')
+            for name in ('primary', 'acme', 'globex')
+        }
+        self.app = self.create_app()
+
+    def create_app(self, **config):
+        return create_app(dict(
+            sqlite_config(self.urls['primary']),
+            TENANT_SHARDS={'acme': self.urls['acme'],
+                           'globex': self.urls['globex']},
+            **config))
+
+    def tearDown(self):
+        self.tearDownShards()
+        shutil.rmtree(self.tmp)
+
+    def tearDownShards(self):
+        self.app.extensions['shards'].dispose()
+        db.get_engine(self.app).dispose()
+
+    def headers(self, tenant=None, sub='local|test-user'):
+        claims = {} if tenant is None else {'org_id': tenant}
+        return self.signer.headers(
+            ROLE_PERMISSIONS['executive_producer'], sub=sub, **claims)
+
+    def names(self, database):
+        # The actor names committed to one of the databases.
+        engine = create_engine(self.urls[database])
+        with engine.connect() as connection:
+            names = sorted(row[0] for row in
+                           connection.execute('SELECT name FROM "Actor"'))
+        engine.dispose()
+        return names
+
+    def post_actor(self, tenant, name):
+        res = self.app.test_client().post('/actors', json={
+            'name': name, 'age': 40, 'gender': 'F'
+        }, headers=self.headers(tenant))
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['actor']
+
+    def list_actors(self, tenant):
+        res = self.app.test_client().get(
+            '/actors', headers=self.headers(tenant))
+        if res.status_code == 404:
+            return []
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_tenants_write_to_their_own_shard(self):
+        self.post_actor('acme', 'Acme Actor')
+        self.post_actor('globex', 'Globex Actor')
+        self.post_actor(None, 'Untenanted Actor')
+
+        self.assertEqual(self.names('acme'), ['Acme Actor'])
+        self.assertEqual(self.names('globex'), ['Globex Actor'])
+        self.assertEqual(self.names('primary'), ['Untenanted Actor'])
+
+    def test_tenants_without_a_shard_are_refused(self):
+        client = self.app.test_client()
+        for tenant in ('initech', 42, ['acme']):
+            res = client.post('/actors', json={
+                'name': 'Refused Actor', 'age': 40, 'gender': 'F'
+            }, headers=self.headers(tenant))
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data)['message'], 'forbidden')
+            res = client.get('/actors', headers=self.headers(tenant))
+            self.assertEqual(res.status_code, 403)
+
+        for database in ('primary', 'acme', 'globex'):
+            self.assertEqual(self.names(database), [])
+
+    def test_tenant_claims_are_ignored_without_shards(self):
+        self.tearDownShards()
+        self.app = create_app(sqlite_config(self.urls['primary']))
+        self.post_actor('initech', 'Initech Actor')
+        self.assertEqual(self.names('primary'), ['Initech Actor'])
+
+    def test_jobs_of_a_tenant_without_a_shard_fail(self):
+        with self.app.app_context():
+            job = jobs.submit('import_actors', {'actors': [
+                {'name': 'Imported', 'age': 30, 'gender': 'M'}
+            ]}, 'local|test-user', 'initech')
+            jobs.run_next()
+            self.assertEqual(job.status, 'failed')
+            db.session.remove()
+
+        self.assertEqual(self.names('primary'), [])
+
+    def test_tenants_only_read_their_own_rows(self):
+        # Both rows get id 1, and version 1, in their shard, neither the
+        # row cache nor request coalescing may mix them up.
+        acme = self.post_actor('acme', 'Acme Actor')
+        globex = self.post_actor('globex', 'Globex Actor')
+        self.assertEqual(acme['id'], globex['id'])
+
+        for _ in range(2):
+            self.assertEqual(self.list_actors('acme'), ['Acme Actor'])
+            self.assertEqual(self.list_actors('globex'), ['Globex Actor'])
+        self.assertEqual(self.list_actors(None), [])
+
+        res = self.app.test_client().get(
+            '/actors/{}'.format(acme['id']), headers=self.headers('globex'))
+        self.assertEqual(json.loads(res.data)['actor']['name'],
+                         'Globex Actor')
+
+    def test_update_invalidates_only_its_shard_cache(self):
+        acme = self.post_actor('acme', 'Acme Actor')
+        self.post_actor('globex', 'Globex Actor')
+        self.list_actors('acme')
+        self.list_actors('globex')
+
+        res = self.app.test_client().patch(
+            '/actors/{}'.format(acme['id']), json={'name': 'Renamed'},
+            headers=self.headers('acme'))
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.list_actors('acme'), ['Renamed'])
+        self.assertEqual(self.list_actors('globex'), ['Globex Actor'])
+
+    def test_jobs_are_queued_in_primary_and_run_on_the_shard(self):
+        res = self.app.test_client().post('/jobs', json={
+            'kind': 'import_actors',
+            'params': {'actors': [{'name': 'Imported', 'age': 30,
+                                   'gender': 'M'}]}
+        }, headers=self.headers('acme'))
+        self.assertEqual(res.status_code, 202)
+        location = res.headers['Location']
+
+        with self.app.app_context():
+            self.assertEqual(Job.query.one().tenant, 'acme')
+            jobs.run_next()
+            db.session.remove()
+
+        self.assertEqual(self.names('acme'), ['Imported'])
+        self.assertEqual(self.names('primary'), [])
+        res = self.app.test_client().get(
+            location, headers=self.headers('acme'))
+        self.assertEqual(json.loads(res.data)['job']['status'], 'done')
+        # The same client can not see the job from another tenant.
+        res = self.app.test_client().get(
+            location, headers=self.headers('globex'))
+        self.assertEqual(res.status_code, 404)
+
+    def test_group_commit_writes_each_tenant_to_its_shard(self):
+        self.app = self.create_app(GROUP_COMMIT=True,
+                                   GROUP_COMMIT_MAX_DELAY_MS=50)
+        tenants = ['acme', 'globex', None] * 2
+        barrier = threading.Barrier(len(tenants))
+        errors = []
+
+        def post(index, tenant):
+            barrier.wait()
+            try:
+                self.post_actor(tenant, 'Actor {}'.format(index))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=post, args=(index, tenant))
+                   for index, tenant in enumerate(tenants)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.names('acme'), ['Actor 0', 'Actor 3'])
+        self.assertEqual(self.names('globex'), ['Actor 1', 'Actor 4'])
+        self.assertEqual(self.names('primary'), ['Actor 2', 'Actor 5'])
+
+    def test_shard_map_from_environment(self):
+        search_path = 'postgresql://db/casting?options=-csearch_path%3Dacme'
+        env = {'TENANT_SHARDS':
+               'acme=' + search_path + ', globex = sqlite:///globex.db,'}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(shard_urls(Flask(__name__)), {
+                'acme': search_path,
+                'globex': 'sqlite:///globex.db'
+            })
+
+
+'''
+MoviePartitionTestCase
+    Checks with EXPLAIN that date filtered movie queries only scan the
+    matching partitions. Needs the live casting_test database upgraded
+    with the migrations, so the Movie table is partitioned.
+'''
+
+
+@unittest.skipUnless(TEST_PROFILE == 'live', 'needs partitioned Postgres')
+class MoviePartitionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': dbp.format(pg, p, p, l, 'casting_test'),
+            'DB_CREATE_ALL': False
+        })
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.engine = db.get_engine(self.app)
+        with self.engine.connect() as connection:
+            if not partitions.is_partitioned(connection):
+                self.ctx.pop()
+                self.skipTest('Movie is not partitioned.')
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+
+    def explain(self, released_from, released_to):
+        # EXPLAIN the query GET /movies?released_from=&released_to= makes.
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            statements.append((statement, parameters))
+
+        event.listen(self.engine, 'before_cursor_execute', capture)
+        try:
+            queries.movie_rows_released(released_from, released_to)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', capture)
+        statement, parameters = statements[-1]
+        with self.engine.connect() as connection:
+            return '\n'.join(row[0] for row in connection.execute(
+                'EXPLAIN ' + statement, parameters))
+
+    def test_one_year_scans_one_partition(self):
+        plan = self.explain(datetime.date(2019, 1, 1),
+                            datetime.date(2019, 12, 31))
+
+        self.assertIn('Movie_y2019', plan)
+        for other in ('Movie_y2018', 'Movie_y2020', 'Movie_old',
+                      'Movie_default'):
+            self.assertNotIn(other, plan)
+
+    def test_add_partitions_after_archive_keeps_archived_years(self):
+        # DDL is transactional on Postgres, the rollback undoes it all.
+        with self.engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                archived = partitions.archive(connection, 2000, detach=True)
+                created = partitions.ensure_partitions(connection)
+                self.assertEqual(set(created) & set(archived), set())
+                for name in created:
+                    self.assertGreaterEqual(
+                        partitions.partition_year(name), 2000)
+            finally:
+                transaction.rollback()
+
+    def test_open_range_scans_later_partitions(self):
+        plan = self.explain(datetime.date(2020, 1, 1), datetime.date.max)
+
+        self.assertIn('Movie_y2020', plan)
+        self.assertIn('Movie_default', plan)
+        self.assertNotIn('Movie_y2019', plan)
+        self.assertNotIn('Movie_old', plan)
+
 
 # Make the tests conveniently executable.
 if __name__ == "__main__":
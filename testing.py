@@ -0,0 +1,135 @@
+import base64
+import datetime
+import time
+
+'''
+Offline test and benchmark helpers
+
+    LocalSigner stands in for Auth0: it generates an RSA key, installs the
+    matching JWKS in auth.py so requires_auth never goes to the network,
+    and signs tokens with the issuer and audience the app expects.
+
+    sqlite_config() and seed_casting_data() give a SQLite database with
+    the same sample rows as casting.psql.
+'''
+
+# The roles from the README and the permissions Auth0 grants each of them.
+ROLE_PERMISSIONS = {
+    'casting_assistant': ['get:actors', 'get:movies'],
+    'casting_director': [
+        'get:actors', 'get:movies', 'post:actors', 'patch:actors',
+        'patch:movies', 'delete:actors'
+    ],
+    'executive_producer': [
+        'get:actors', 'get:movies', 'post:actors', 'post:movies',
+        'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+    ]
+}
+
+CASTING_ACTORS = [
+    ('Leonardo DiCaprio', 45, 'M'),
+    ('Cameron Diaz', 47, 'F'),
+    ('Matt Damon', 49, 'M'),
+    ('Kate Winslet', 44, 'F'),
+    ('Robert Downey, Jr.', 54, 'M')
+]
+
+CASTING_MOVIES = [
+    ('1917', datetime.date(2020, 1, 8)),
+    ('Joker', datetime.date(2019, 8, 31)),
+    ('Parasite', datetime.date(2019, 5, 21)),
+    ('The Irishman', datetime.date(2019, 11, 4)),
+    ('Once Upon a Time in Hollywood', datetime.date(2019, 5, 21))
+]
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def generate_rsa_key():
+    # Returns (private key PEM, public modulus, public exponent) using
+    # cryptography when installed, else pycryptodome.
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        from Crypto.PublicKey import RSA
+        key = RSA.generate(2048)
+        return key.exportKey('PEM').decode('ascii'), key.n, key.e
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption())
+    numbers = key.public_key().public_numbers()
+    return pem.decode('ascii'), numbers.n, numbers.e
+
+
+class LocalSigner:
+    def __init__(self, kid='local-test-key'):
+        import auth
+        self.kid = kid
+        self.private_pem, n, e = generate_rsa_key()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64url_uint(n),
+            'e': b64url_uint(e)
+        }]}
+        auth.load_jwks(self.jwks)
+
+    def token(self, permissions, sub='local|test-user', audience=None,
+              expires_in=3600, **claims):
+        import auth
+        from jose import jwt
+        config = auth.auth_config()
+        payload = {
+            'iss': 'https://' + config['AUTH0_DOMAIN'] + '/',
+            'sub': sub,
+            'aud': audience or config['API_AUDIENCE'],
+            'iat': int(time.time()),
+            'exp': int(time.time()) + expires_in,
+            'permissions': permissions
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def headers(self, permissions, **kwargs):
+        return {
+            'Authorization': 'Bearer ' + self.token(permissions, **kwargs)
+        }
+
+
+def sqlite_config(database_url='sqlite://'):
+    # App config for a SQLite database. The in-memory database is kept on
+    # one shared connection so every thread and request sees the same data.
+    config = {
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'SQLALCHEMY_REPLICA_URIS': [],
+        'TENANT_SHARDS': {},
+        'DB_CREATE_ALL': True
+    }
+    if database_url == 'sqlite://':
+        from sqlalchemy.pool import StaticPool
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'poolclass': StaticPool,
+            'connect_args': {'check_same_thread': False}
+        }
+    return config
+
+
+def seed_casting_data():
+    # Inserts the casting.psql sample rows, call inside an app context.
+    from models import db, Actor, Movie
+    db.session.add_all(
+        Actor(name=name, age=age, gender=gender)
+        for name, age, gender in CASTING_ACTORS)
+    db.session.add_all(
+        Movie(title=title, release_date=release_date)
+        for title, release_date in CASTING_MOVIES)
+    db.session.commit()
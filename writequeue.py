@@ -0,0 +1,189 @@
+from concurrent.futures import Future, TimeoutError
+from models import db, unit_of_work
+import logging
+import os
+import queue
+import threading
+import time
+import routing
+import tenants
+
+logger = logging.getLogger(__name__)
+
+'''
+Group commit
+
+    GroupCommitWriter collects the inserts submitted by concurrent requests
+    of one worker and commits them together. A background thread waits up
+    to max_delay seconds after the first insert of a batch, or until
+    max_batch inserts are queued, then writes the whole batch in one
+    transaction. Each caller blocks until its own row is committed and gets
+    back the row's format(), or the exception its row raised. Inserts of
+    different tenants are committed separately, each to its own shard
+    (see tenants.py).
+
+    A longer delay or a bigger batch gives more inserts per commit, at the
+    cost of added latency on each POST. Enable it with GROUP_COMMIT=true.
+    GROUP_COMMIT_MAX_DELAY_MS (default 5) and GROUP_COMMIT_MAX_BATCH
+    (default 100) tune it.
+'''
+
+
+class ValidationError(Exception):
+    pass
+
+
+class WriteUnavailable(Exception):
+    # The row was not written: its batch failed, or it was still queued
+    # when the caller stopped waiting.
+    pass
+
+
+class _Insert:
+    def __init__(self, build, unique, taken, tenant):
+        self.build = build
+        self.unique = unique
+        self.taken = taken
+        self.tenant = tenant
+        self.future = Future()
+
+
+class GroupCommitWriter:
+    def __init__(self, app, max_batch=100, max_delay=0.005):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    '''
+        @INPUTS
+            build: returns the new, not yet added, model instance
+            unique: a key no two rows of the batch may share, or None
+            taken: returns True when unique is already in the database
+
+        Queue one insert and wait until its batch is committed.
+        Raise ValidationError if unique is already taken, WriteUnavailable
+        if the row was not written.
+        return the committed row's format()
+    '''
+
+    def submit(self, build, unique=None, taken=None, timeout=30):
+        item = _Insert(build, unique, taken, tenants.current_tenant())
+        self._ensure_started().put(item)
+        try:
+            result = item.future.result(timeout)
+        except TimeoutError:
+            # A row still in the queue is dropped, so it can not be written
+            # after the client was told it failed. A row the writer has
+            # already started on is waited for.
+            if item.future.cancel():
+                raise WriteUnavailable('Timed out in the group commit queue.')
+            result = item.future.result()
+        routing.note_write()
+        return result
+
+    def _ensure_started(self):
+        # The writer thread is started on first use, and again in a forked
+        # worker, since threads do not survive a fork.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                threading.Thread(
+                    target=self._run, args=(self._queue,),
+                    name='group-commit', daemon=True).start()
+            return self._queue
+
+    def _run(self, items):
+        while True:
+            batch = [items.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(items.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            by_tenant = {}
+            for item in batch:
+                by_tenant.setdefault(item.tenant, []).append(item)
+            for tenant, group in by_tenant.items():
+                self._write_group(tenant, group)
+
+    def _write_group(self, tenant, group):
+        # Each tenant's rows get a session of their own.
+        with self.app.app_context(), tenants.using(tenant):
+            try:
+                self._write(group)
+            except Exception:
+                logger.exception('Group commit failed.')
+                for item in group:
+                    if not item.future.done():
+                        item.future.set_exception(
+                            WriteUnavailable('Group commit failed.'))
+            finally:
+                db.session.remove()
+
+    def _write(self, batch):
+        accepted = []
+        seen = set()
+        for item in batch:
+            # Skip the rows whose callers gave up waiting.
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            if item.unique is not None:
+                if item.unique in seen or item.taken():
+                    item.future.set_exception(ValidationError(item.unique))
+                    continue
+                seen.add(item.unique)
+            accepted.append(item)
+        if not accepted:
+            return
+
+        try:
+            with unit_of_work():
+                rows = [item.build() for item in accepted]
+                db.session.add_all(rows)
+                db.session.flush()
+                results = [row.format() for row in rows]
+        except Exception:
+            # Find the rows at fault by writing each one on its own, so a
+            # single bad insert only fails its own request.
+            for item in accepted:
+                self._write_one(item)
+            return
+        for item, result in zip(accepted, results):
+            item.future.set_result(result)
+
+    def _write_one(self, item):
+        try:
+            with unit_of_work():
+                row = item.build()
+                db.session.add(row)
+                db.session.flush()
+                result = row.format()
+        except Exception as error:
+            item.future.set_exception(error)
+        else:
+            item.future.set_result(result)
+
+
+def writer_from_config(app):
+    # Returns a GroupCommitWriter when group commit is enabled, else None.
+    enabled = app.config.get(
+        'GROUP_COMMIT', os.environ.get('GROUP_COMMIT', 'false'))
+    if str(enabled).lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return GroupCommitWriter(
+        app,
+        max_batch=int(app.config.get(
+            'GROUP_COMMIT_MAX_BATCH',
+            os.environ.get('GROUP_COMMIT_MAX_BATCH', 100))),
+        max_delay=float(app.config.get(
+            'GROUP_COMMIT_MAX_DELAY_MS',
+            os.environ.get('GROUP_COMMIT_MAX_DELAY_MS', 5))) / 1000
+        )